@@ -0,0 +1,233 @@
+"""
+Benchmarks for gitstatus
+
+Each benchmark builds a synthetic git repo in a temporary folder and times
+gitstatus inside it. Run all of them with `make bench`, or pick some with
+`python bench_gitstatus.py <name> ...`.
+"""
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import shutil
+import subprocess as sub
+import tempfile
+import time
+
+try:
+    import _gitstatus
+except ImportError:
+    _gitstatus = None
+
+GIT_STATUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'gitstatus')
+
+
+def git(*args):
+    """
+    Run a git command quietly in the CWD.
+    """
+    with open(os.devnull, 'w') as devnull:
+        sub.check_call(('git',) + args, stdout=devnull, stderr=sub.STDOUT)
+
+
+def make_tree(folder, dirs, files):
+    """
+    Fill folder with dirs directories of files one line files each.
+    """
+    for i in range(dirs):
+        path = os.path.join(folder, 'd%04d' % i)
+        os.makedirs(path)
+        for j in range(files):
+            with open(os.path.join(path, 'f%04d' % j), 'w') as fout:
+                fout.write('%d %d\n' % (i, j))
+
+
+def time_gitstatus(runs, *args):
+    """
+    Run gitstatus in the CWD runs times.
+
+    Returns:
+        The median wall time in milliseconds and the last output.
+    """
+    timings = []
+    out = ''
+    with open(os.devnull, 'r') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            out = sub.check_output([GIT_STATUS] + list(args), stdin=devnull)
+            timings.append((time.time() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], out.decode('utf-8', errors='ignore')
+
+
+def bench_sparse(runs, dirs=200, files=100):
+    """
+    Full checkout against a cone mode sparse checkout with a sparse index
+    and a blobless partial clone of the same history.
+    """
+    folder = tempfile.mkdtemp()
+    upstream = os.path.join(folder, 'upstream')
+    cwd = os.getcwd()
+    try:
+        os.makedirs(upstream)
+        os.chdir(upstream)
+        git('init')
+        git('config', 'user.email', 'you@example.com')
+        git('config', 'user.name', 'Your Name')
+        git('config', 'uploadpack.allowFilter', 'true')
+        make_tree(upstream, dirs, files)
+        git('add', '.')
+        git('commit', '-m', 'synthetic tree')
+
+        results = [('full', upstream)]
+
+        sparse = os.path.join(folder, 'sparse')
+        git('clone', '--no-checkout', upstream, sparse)
+        git('-C', sparse, 'sparse-checkout', 'set', '--cone',
+            '--sparse-index', 'd0000')
+        git('-C', sparse, 'checkout', 'master')
+        results.append(('sparse', sparse))
+
+        partial = os.path.join(folder, 'partial')
+        git('clone', '--filter=blob:none', '--no-checkout',
+            'file://' + upstream, partial)
+        git('-C', partial, 'sparse-checkout', 'set', '--cone',
+            '--sparse-index', 'd0000')
+        git('-C', partial, 'checkout', 'master')
+        results.append(('partial', partial))
+
+        print('sparse: %d files in %d directories' % (dirs * files, dirs))
+        for name, path in results:
+            os.chdir(path)
+            median, out = time_gitstatus(runs)
+            print('  %-8s %8.2f ms  %s' % (name, median, out))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_parse(runs, iterations=1000000):
+    """
+    The parsing core alone, through the bench_parse driver, with no git
+    process involved.
+    """
+    bench_parse_bin = os.path.join(os.path.dirname(GIT_STATUS), 'bench_parse')
+    out = ''
+    for _ in range(max(1, runs // 10)):
+        out = sub.check_output([bench_parse_bin, str(iterations)])
+    print('parse: ' + out.decode('utf-8').strip())
+
+
+def bench_batch(runs, repos=50):
+    """
+    One gitstatus process per repo against a single --batch process
+    reading all the repos from stdin, and against the Python binding
+    when it is built.
+    """
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        paths = []
+        for i in range(repos):
+            path = os.path.join(folder, 'r%03d' % i)
+            os.makedirs(path)
+            os.chdir(path)
+            git('init')
+            make_tree(path, 2, 5)
+            paths.append(path)
+
+        spawn, batch, binding = [], [], []
+        lines = ''.join(p + '\n' for p in paths).encode('utf-8')
+        for _ in range(runs):
+            start = time.time()
+            for path in paths:
+                os.chdir(path)
+                with open(os.devnull, 'r') as devnull:
+                    sub.check_output([GIT_STATUS], stdin=devnull)
+            spawn.append((time.time() - start) * 1000)
+
+            start = time.time()
+            proc = sub.Popen([GIT_STATUS, '--batch'], stdin=sub.PIPE,
+                             stdout=sub.PIPE)
+            proc.communicate(lines)
+            batch.append((time.time() - start) * 1000)
+
+            if _gitstatus is not None:
+                start = time.time()
+                _gitstatus.status_many(paths)
+                binding.append((time.time() - start) * 1000)
+
+        print('batch: %d repos' % repos)
+        for name, timings in (('spawn', spawn), ('batch', batch),
+                              ('binding', binding)):
+            if timings:
+                timings.sort()
+                print('  %-8s %8.2f ms' % (name, timings[len(timings) // 2]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def bench_untracked(runs, dirs=100, files=1000):
+    """
+    An untracked node_modules directory, walked by git status against
+    pruned with --untracked-prune: in the default normal mode, where nothing
+    is pruned, with status.showUntrackedFiles=all, and with all when an
+    ignore pattern covers its files.
+    """
+    folder = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(folder)
+        git('init')
+        git('config', 'user.email', 'you@example.com')
+        git('config', 'user.name', 'Your Name')
+        make_tree(folder, 2, 5)
+        git('add', '.')
+        git('commit', '-m', 'tracked tree')
+        make_tree(os.path.join(folder, 'node_modules'), dirs, files)
+
+        print('untracked: %d files in node_modules' % (dirs * files))
+        for name, exclude, show in (('normal', '', 'normal'),
+                                    ('all', '', 'all'),
+                                    ('ignored', 'f0*\n', 'all')):
+            with open(os.path.join('.git', 'info', 'exclude'), 'w') as fout:
+                fout.write(exclude)
+            git('config', 'status.showUntrackedFiles', show)
+            for prune in ((), ('--untracked-prune=node_modules',)):
+                median, out = time_gitstatus(runs, *prune)
+                print('  %-8s %-7s %8.2f ms  %s' % (
+                    name, 'pruned' if prune else 'walked', median, out))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'parse': bench_parse,
+    'sparse': bench_sparse,
+    'untracked': bench_untracked,
+}
+
+
+def main():
+    """
+    Run the benchmarks named on the command line, all by default.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='one of: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--runs', type=int, default=20,
+                        help='timed runs per case (default: %(default)s)')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name](args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#define _DEFAULT_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "gitstatus.h"
+
+#define STAT_LINES 100
+
+static char arena_buffer[GS_ARENA_SIZE];
+static char lines[STAT_LINES][64];
+static size_t lengths[STAT_LINES];
+static char header[1024];
+
+/* time the parsing core alone on a synthetic porcelain status, in one process */
+int main(int argc, char **argv)
+{
+    static const char *codes[] = {"M ", " M", "A ", "??", "UU", "R ", " D"};
+    struct gs_arena arena;
+    struct gs_status st;
+    struct timespec start, end;
+    long iterations = argc > 1 ? atol(argv[1]) : 1000000;
+    long n, checksum = 0;
+    size_t header_len, high_water = 0;
+    double elapsed;
+    int i;
+
+    gs_arena_init(&arena, arena_buffer, sizeof(arena_buffer));
+
+    /* a branch name well past the old 128 byte limit */
+    header_len = snprintf(header, sizeof(header), "## feature/%0300d...origin/feature/%0300d [ahead 3, behind 12]", 0,
+                          0);
+
+    for (i = 0; i < STAT_LINES; i++)
+        lengths[i] = snprintf(lines[i], sizeof(lines[i]), "%s src/file%03d.c", codes[i % 7], i);
+
+    clock_gettime(CLOCK_MONOTONIC, &start);
+
+    for (n = 0; n < iterations; n++) {
+        gs_arena_reset(&arena);
+        gs_status_init(&st);
+
+        if (gs_parse_branch(&arena, header, header_len, -1, &st) < 0) {
+            fprintf(stderr, "arena exhausted\n");
+            return EXIT_FAILURE;
+        }
+
+        for (i = 0; i < STAT_LINES; i++)
+            gs_parse_stat_line(lines[i], lengths[i], &st);
+
+        checksum += st.staged + st.changed + st.behind + (long)st.branch_len;
+        if (arena.used > high_water)
+            high_water = arena.used;
+    }
+
+    clock_gettime(CLOCK_MONOTONIC, &end);
+
+    elapsed = (end.tv_sec - start.tv_sec) + (end.tv_nsec - start.tv_nsec) / 1e9;
+
+    printf("%ld statuses of %d lines in %.3f s, %.1f ns per status, arena high water %lu bytes (checksum %ld)\n",
+           iterations, STAT_LINES + 1, elapsed, elapsed * 1e9 / (iterations ? iterations : 1),
+           (unsigned long)high_water, checksum);
+
+    return EXIT_SUCCESS;
+}
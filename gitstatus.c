@@ -1,246 +1,437 @@
 #define _DEFAULT_SOURCE
 #include <stdio.h>
 #include <stdlib.h>
-#include <ctype.h>
 #include <string.h>
+#include <time.h>
 #include <unistd.h>
+#include <fcntl.h>
 #include <sys/stat.h>
-#include <libgen.h>
 
-#define MAX_PATH_LENGTH 1024
-#define MAX_NAME_LENGTH 128
+#include "gitstatus.h"
+
+#define MAX_PATH_LENGTH 4096
+#define LOG_SIZE_KB 1024
+#define REPORT_THRESHOLD_MS 100
+#define HISTOGRAM_BUCKETS 13
+#define HISTOGRAM_WIDTH 40
+
+struct cli_options {
+    struct gs_options gs;
+    int batch;
+    const char *log;
+    long log_size;
+    int report;
+    long threshold;
+};
+
+/* per repository totals of the latency log */
+struct repo_latency {
+    char *root;
+    char size[8];
+    long files;
+    long runs;
+    long slow;
+    long total_us;
+    long max_us;
+    long ab[4];
+    long histogram[HISTOGRAM_BUCKETS];
+    struct repo_latency *next;
+};
+
+static const char *ab_names[] = {"none", "hit", "miss", "approx"};
+static const char *submodule_names[] = {"default", "ignore", "dirty", "full"};
+
+/* upper bounds in milliseconds, the last bucket is open ended */
+static const long bucket_ms[HISTOGRAM_BUCKETS - 1] = {1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000};
+
+/* one arena for the whole process, reset before every status */
+static char arena_buffer[GS_ARENA_SIZE];
+static char batch_line[MAX_PATH_LENGTH];
+static char log_line[MAX_PATH_LENGTH + 256];
+static char log_path[MAX_PATH_LENGTH];
+
+static long now_us(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+
+    return ts.tv_sec * 1000000L + ts.tv_nsec / 1000L;
+}
 
-int is_directory(char *path)
+char *option_value(char *arg, char *name)
 {
-    struct stat path_stat;
+    size_t n = strlen(name);
 
-    stat(path, &path_stat);
+    if (strncmp(arg, name, n) == 0 && arg[n] == '=')
+        return arg + n + 1;
 
-    return S_ISDIR(path_stat.st_mode);
+    return NULL;
 }
 
-int is_file(char *path)
+void parse_options(int argc, char **argv, struct cli_options *opts)
 {
-    struct stat path_stat;
+    char *value;
+    int i;
+
+    gs_options_init(&opts->gs);
+    opts->batch = 0;
+    opts->log = NULL;
+    opts->log_size = LOG_SIZE_KB * 1024L;
+    opts->report = 0;
+    opts->threshold = REPORT_THRESHOLD_MS;
+
+    for (i = 1; i < argc; i++) {
+        if ((value = option_value(argv[i], "--submodules")) != NULL) {
+            if (strcmp(value, "ignore") == 0)
+                opts->gs.submodules = GS_SUBMODULES_IGNORE;
+            else if (strcmp(value, "dirty") == 0)
+                opts->gs.submodules = GS_SUBMODULES_DIRTY;
+            else if (strcmp(value, "full") == 0)
+                opts->gs.submodules = GS_SUBMODULES_FULL;
+            else if (strcmp(value, "default") != 0)
+                goto usage;
+        } else if ((value = option_value(argv[i], "--jobs")) != NULL) {
+            if ((opts->gs.jobs = atoi(value)) < 1)
+                goto usage;
+        } else if ((value = option_value(argv[i], "--submodule-timeout")) != NULL) {
+            if ((opts->gs.submodule_timeout = atoi(value)) < 0)
+                goto usage;
+        } else if (strcmp(argv[i], "--ahead-behind-cache") == 0) {
+            opts->gs.ab_cache = 1;
+        } else if ((value = option_value(argv[i], "--ahead-behind-timeout")) != NULL) {
+            if ((opts->gs.ab_timeout = atoi(value)) < 0)
+                goto usage;
+        } else if ((value = option_value(argv[i], "--fetch-interval")) != NULL) {
+            if ((opts->gs.fetch_interval = atoi(value)) < 0)
+                goto usage;
+        } else if ((value = option_value(argv[i], "--fetch-jobs")) != NULL) {
+            if ((opts->gs.fetch_jobs = atoi(value)) < 1)
+                goto usage;
+        } else if ((value = option_value(argv[i], "--untracked-prune")) != NULL) {
+            opts->gs.untracked_prune = value;
+        } else if ((value = option_value(argv[i], "--untracked-max-depth")) != NULL) {
+            if ((opts->gs.untracked_max_depth = atoi(value)) < 0)
+                goto usage;
+        } else if (strcmp(argv[i], "--batch") == 0) {
+            opts->batch = 1;
+        } else if ((value = option_value(argv[i], "--log")) != NULL) {
+            opts->log = value;
+        } else if ((value = option_value(argv[i], "--log-size")) != NULL) {
+            if ((opts->log_size = atol(value) * 1024L) <= 0)
+                goto usage;
+        } else if (strcmp(argv[i], "--report") == 0) {
+            opts->report = 1;
+        } else if ((value = option_value(argv[i], "--threshold")) != NULL) {
+            if ((opts->threshold = atol(value)) < 0)
+                goto usage;
+        } else {
+            goto usage;
+        }
+    }
+
+    if (opts->log != NULL && strlen(opts->log) >= MAX_PATH_LENGTH - 2)
+        goto usage;
+    if (!opts->report || opts->log != NULL)
+        return;
 
-    stat(path, &path_stat);
+usage:
+    fprintf(stderr,
+            "usage: %s [--submodules=default|ignore|dirty|full] [--jobs=N] [--submodule-timeout=MS]\n"
+            "       [--ahead-behind-cache] [--ahead-behind-timeout=MS] [--fetch-interval=SECONDS]\n"
+            "       [--fetch-jobs=N] [--untracked-prune=DIR,...] [--untracked-max-depth=N]\n"
+            "       [--batch] [--log=FILE] [--log-size=KB]\n"
+            "       %s --report --log=FILE [--threshold=MS]\n",
+            argv[0], argv[0]);
+    exit(EXIT_FAILURE);
+}
 
-    return S_ISREG(path_stat.st_mode);
+static const char *size_class(long files)
+{
+    if (files < 0)
+        return "-";
+    if (files < 1000)
+        return "xs";
+    if (files < 10000)
+        return "s";
+    if (files < 100000)
+        return "m";
+    if (files < 1000000)
+        return "l";
+    return "xl";
 }
 
-void rebase_progress(char *rebase_dir, char *rebase, int len)
+/*
+ * Append one CSV record, moving a log past its size cap to FILE.1 first:
+ * epoch,wall_us,files,size,ab_cache,mode,submodules,root
+ * The root comes last as the only field that may hold a comma.
+ */
+void log_status(const struct cli_options *opts, const struct gs_status *st, long wall_us)
 {
-    int next = 0, last = 0;
-    char next_file_path[MAX_PATH_LENGTH];
-    char last_file_path[MAX_PATH_LENGTH];
-    FILE *fp;
+    struct stat log_stat;
+    char mode[48] = "-";
+    int len, fd;
+
+    if (st->mode != 0)
+        gs_mode_name(st->mode, mode, sizeof(mode));
 
-    snprintf(next_file_path, sizeof(next_file_path), "%s/next", rebase_dir);
-    snprintf(last_file_path, sizeof(last_file_path), "%s/last", rebase_dir);
+    len = snprintf(log_line, sizeof(log_line), "%ld,%ld,%ld,%s,%s,%s,%s,%.*s\n", (long)time(NULL), wall_us,
+                   st->files, size_class(st->files), ab_names[st->ab_state], mode,
+                   submodule_names[opts->gs.submodules], (int)st->root_len, st->root);
 
-    if (!is_file(next_file_path) || !is_file(last_file_path))
+    if (len >= (int)sizeof(log_line) || memchr(st->root, '\n', st->root_len) != NULL)
         return;
 
-    if ((fp = fopen(next_file_path, "r")) != NULL) {
-        fscanf(fp, "%d", &next);
-        fclose(fp);
+    if (stat(opts->log, &log_stat) == 0 && log_stat.st_size >= opts->log_size) {
+        snprintf(log_path, sizeof(log_path), "%s.1", opts->log);
+        rename(opts->log, log_path);
     }
 
-    if ((fp = fopen(last_file_path, "r")) != NULL) {
-        fscanf(fp, "%d", &last);
-        fclose(fp);
+    /* one O_APPEND write per record, so shells logging at once do not interleave */
+    if ((fd = open(opts->log, O_WRONLY | O_APPEND | O_CREAT, 0644)) >= 0) {
+        if (write(fd, log_line, len) != len)
+            fprintf(stderr, "Cannot write %s\n", opts->log);
+        close(fd);
     }
-
-    snprintf(rebase, len, "%d/%d", next, last);
 }
 
-int stash_count(char *stash_file)
+int print_status(const char *dir, int in_fd, const struct cli_options *opts, struct gs_arena *arena)
 {
-    FILE *fp;
-    int ch;
-    int stashes = 0;
-
-    if ((fp = fopen(stash_file, "r")) != NULL) {
-        while ((ch = fgetc(fp)) != EOF) {
-            if (ch == '\n') {
-                stashes++;
-            }
-        }
+    long start = now_us();
+    struct gs_status st;
+    char *out;
+    int len;
+
+    gs_arena_reset(arena);
 
-        fclose(fp);
+    switch (gs_collect(dir, in_fd, &opts->gs, arena, &st)) {
+    case GS_OK:
+        break;
+    case GS_NOT_A_REPO:
+        fprintf(stderr, "Not a git repository\n");
+        return 0;
+    case GS_NO_GIT_ROOT:
+        fprintf(stderr, "Cannot find git root\n");
+        return 0;
+    default:
+        fprintf(stderr, "Cannot run git\n");
+        return 0;
     }
 
-    return stashes;
-}
+    len = gs_format(&st, NULL, 0);
 
-int parse_ahead_behind(char *branch, char *what)
-{
-    char *pos;
-    int value = 0;
+    if ((out = gs_alloc(arena, len + 1)) == NULL) {
+        fprintf(stderr, "Status too long\n");
+        return 0;
+    }
+
+    gs_format(&st, out, len + 1);
+    fputs(out, stdout);
+
+    if (opts->log != NULL) {
+        fflush(stdout);
+        log_status(opts, &st, now_us() - start);
+    }
 
-    pos = strstr(branch, what);
+    return 1;
+}
 
-    if (pos != NULL) {
-        for (pos += strlen(what); isdigit(*pos); pos++) {
-            value = value * 10 + *pos - '0';
+static struct repo_latency *find_repo(struct repo_latency **repos, struct gs_arena *arena, const char *root)
+{
+    struct repo_latency *repo, **prev;
+    size_t len = strlen(root);
+
+    /* most recently seen first, consecutive prompts are mostly in the same repository */
+    for (prev = repos; (repo = *prev) != NULL; prev = &repo->next) {
+        if (strcmp(repo->root, root) == 0) {
+            *prev = repo->next;
+            break;
         }
     }
 
-    return value;
+    if (repo == NULL) {
+        if ((repo = gs_alloc(arena, sizeof(*repo))) == NULL || (repo->root = gs_alloc(arena, len + 1)) == NULL)
+            return NULL;
+        memset(repo->histogram, 0, sizeof(repo->histogram));
+        memset(repo->ab, 0, sizeof(repo->ab));
+        memcpy(repo->root, root, len + 1);
+        repo->runs = repo->slow = repo->total_us = repo->max_us = 0;
+    }
+
+    repo->next = *repos;
+    *repos = repo;
+
+    return repo;
 }
 
-void parse_branch(char *line, char *head_file, char *branch, char *upstream, int *local)
+static int read_log(const char *path, long threshold_us, struct repo_latency **repos, struct gs_arena *arena)
 {
-    int i, j;
-    FILE *fp;
+    struct repo_latency *repo;
+    char size[8], ab[16], mode[48], submodules[16];
+    long epoch, wall_us, files;
+    FILE *in;
+    int i, n;
 
-    if (strstr(line, "no branch") != NULL) {
-        *local = 0;
+    if ((in = fopen(path, "r")) == NULL)
+        return 0;
 
-        if ((fp = fopen(head_file, "r")) != NULL) {
-            branch[0] = ':';
-            fgets(branch + 1, 8, fp);
-            fclose(fp);
+    while (fgets(log_line, sizeof(log_line), in) != NULL) {
+        log_line[strcspn(log_line, "\n")] = '\0';
+
+        if (sscanf(log_line, "%ld,%ld,%ld,%7[^,],%15[^,],%47[^,],%15[^,],%n", &epoch, &wall_us, &files, size, ab,
+                   mode, submodules, &n) != 7 || log_line[n] == '\0')
+            continue;
+
+        if ((repo = find_repo(repos, arena, log_line + n)) == NULL) {
+            fclose(in);
+            return -1;
         }
-    } else if (strstr(line, "Initial commit") != NULL || strstr(line, "No commits yet") != NULL) {
-        for (i = strlen(line); line[i] != ' ' && i >= 0; i--)
+
+        strcpy(repo->size, size);
+        repo->files = files;
+        repo->runs++;
+        repo->total_us += wall_us;
+        if (wall_us > repo->max_us)
+            repo->max_us = wall_us;
+        if (wall_us > threshold_us)
+            repo->slow++;
+
+        for (i = 0; i < HISTOGRAM_BUCKETS - 1 && wall_us >= bucket_ms[i] * 1000; i++)
             ;
-        strcpy(branch, line + i + 1);
-    } else {
-        for (i = 3; (line[i] != '.' || line[i + 1] != '.') && line[i] != '\0'; i++)
-            branch[i - 3] = line[i];
-        branch[i - 3] = '\0';
-
-        if (strstr(line, "...") != NULL) {
-            *local = 0;
-
-            for (j = i + 3; line[j] != '\0' && line[j] != '\n' && line[j] != ' ' && line[j] != '['; j++)
-                upstream[j - i - 3] = line[j];
-            upstream[j - i - 3] = '\0';
-        }
+        repo->histogram[i]++;
+
+        for (i = 0; i < 4; i++)
+            if (strcmp(ab, ab_names[i]) == 0)
+                repo->ab[i]++;
     }
+
+    fclose(in);
+
+    return 0;
 }
 
-void parse_stat_line(char *line, int *staged, int *conflicts, int *changed, int *untracked)
+static int slowest_first(const void *a, const void *b)
 {
-    if (line[0] == '?' && line[1] == '?')
-        ++*untracked;
-
-    if ((line[0] == 'A' && (line[1] == 'A' || line[1] == 'D')) ||
-        (line[0] == 'D' && (line[1] == 'D' || line[1] == 'U')) ||
-        (line[0] == 'U' && (line[1] == 'A' || line[1] == 'D' || line[1] == 'U')))
-        ++*conflicts;
-
-    if (line[0] == 'A' || line[0] == 'C' || line[0] == 'D' || line[0] == 'M' || line[0] == 'R')
-        ++*staged;
-    if (line[1] == 'C' || line[1] == 'D' || line[1] == 'M' || line[1] == 'R')
-        ++*changed;
+    const struct repo_latency *x = *(struct repo_latency *const *)a;
+    const struct repo_latency *y = *(struct repo_latency *const *)b;
+    double mean_x = (double)x->total_us / x->runs;
+    double mean_y = (double)y->total_us / y->runs;
+
+    return mean_x < mean_y ? 1 : mean_x > mean_y ? -1 : 0;
 }
 
-int find_git_root(char *path, int len)
+static void print_histogram(const struct repo_latency *repo)
 {
-    char *cwd, *p;
-    char buff[1024];
-    FILE *fp;
+    long most = 0;
+    int i, first = -1, last = 0, width;
+
+    for (i = 0; i < HISTOGRAM_BUCKETS; i++) {
+        if (repo->histogram[i] == 0)
+            continue;
+        if (first < 0)
+            first = i;
+        last = i;
+        if (repo->histogram[i] > most)
+            most = repo->histogram[i];
+    }
 
-    cwd = getcwd(NULL, 0);
+    for (i = first; i >= 0 && i <= last; i++) {
+        if (i < HISTOGRAM_BUCKETS - 1)
+            printf("    <%5ld ms %6ld", bucket_ms[i], repo->histogram[i]);
+        else
+            printf("    >=%4ld ms %6ld", bucket_ms[i - 1], repo->histogram[i]);
+        width = (int)((repo->histogram[i] * HISTOGRAM_WIDTH + most - 1) / most);
+        if (width > 0)
+            putchar(' ');
+        for (; width > 0; width--)
+            putchar('#');
+        putchar('\n');
+    }
+}
 
-    while (strcmp(cwd, "/")) {
-        snprintf(path, len, "%s/.git", cwd);
+/*
+ * Per repository latency histograms of the log and its rotated copy, the
+ * slowest on average first. A repository is flagged when more than 10% of
+ * its statuses took longer than the threshold, which makes the exit status 1.
+ */
+int report(const char *log, long threshold_ms, struct gs_arena *arena)
+{
+    struct repo_latency *repos = NULL, *repo, **sorted;
+    long runs = 0;
+    int count = 0, flagged = 0, i;
 
-        if (is_directory(path))
-            return 1;
+    snprintf(log_path, sizeof(log_path), "%s.1", log);
 
-        if (is_file(path)) {
-            if ((fp = fopen(path, "r")) == NULL) {
-                perror("fopen");
-                return 0;
-            }
+    if (read_log(log_path, threshold_ms * 1000, &repos, arena) < 0 ||
+        read_log(log, threshold_ms * 1000, &repos, arena) < 0)
+        fprintf(stderr, "Too many repositories, the report is partial\n");
 
-            if (fgets(buff, sizeof buff, fp) == NULL) {
-                perror("fgets");
-                return 0;
-            }
+    for (repo = repos; repo != NULL; repo = repo->next)
+        count++;
 
-            p = buff;
+    if ((sorted = gs_alloc(arena, (count + 1) * sizeof(*sorted))) == NULL) {
+        fprintf(stderr, "Too many repositories\n");
+        return EXIT_FAILURE;
+    }
 
-            while (*p++ != ':'); /* find next to : */
-            while (*++p == ' '); /* strip spaces */
+    for (i = 0, repo = repos; repo != NULL; repo = repo->next) {
+        sorted[i++] = repo;
+        runs += repo->runs;
+    }
 
-            while (*p != ' ' && *p != '\n' && *p != '\r' && *p != '\0')
-                *path++ = *p++;
+    qsort(sorted, count, sizeof(*sorted), slowest_first);
 
-            *path = '\0';
+    printf("%d repositories, %ld statuses, flagged when over %ld ms more than 10%% of the time\n", count, runs,
+           threshold_ms);
 
-            fclose(fp);
+    for (i = 0; i < count; i++) {
+        repo = sorted[i];
 
-            return 1;
-        }
+        printf("\n%s%s\n", repo->root, repo->slow * 10 > repo->runs ? "  SLOW" : "");
+        printf("  size %s (%ld files), %ld statuses, mean %.1f ms, max %.1f ms, %ld over %ld ms\n", repo->size,
+               repo->files, repo->runs, repo->total_us / 1000.0 / repo->runs, repo->max_us / 1000.0, repo->slow,
+               threshold_ms);
+        if (repo->ab[1] + repo->ab[2] + repo->ab[3] > 0)
+            printf("  ahead/behind cache: %ld hit, %ld miss, %ld approx\n", repo->ab[1], repo->ab[2], repo->ab[3]);
+        print_histogram(repo);
 
-        cwd = dirname(cwd);
+        if (repo->slow * 10 > repo->runs)
+            flagged++;
     }
 
-    return 0;
+    return flagged > 0 ? EXIT_FAILURE : EXIT_SUCCESS;
 }
 
-int main()
+int main(int argc, char **argv)
 {
-    FILE *in;
-    char line[MAX_PATH_LENGTH * 2];
-    char branch[MAX_NAME_LENGTH];
-    char upstream[MAX_NAME_LENGTH] = "..";
-    char rebase[MAX_NAME_LENGTH] = "0";
-    char git_root[MAX_PATH_LENGTH];
-    char stash_file[MAX_PATH_LENGTH];
-    char head_file[MAX_PATH_LENGTH];
-    char merge_file[MAX_PATH_LENGTH];
-    char rebase_dir[MAX_PATH_LENGTH];
-    int stashes = 0;
-    int local = 1;
-    int ahead = 0;
-    int behind = 0;
-    int merge = 0;
-    int staged = 0;
-    int conflicts = 0;
-    int changed = 0;
-    int untracked = 0;
-
-    if (!isatty(0))
-        in = stdin;
-    else
-        in = popen("git status --branch --porcelain 2>&1", "r");
+    struct cli_options opts;
+    struct gs_arena arena;
+    struct stat in_stat;
 
-    fgets(line, sizeof(line), in);
-    line[strlen(line) - 1] = '\0'; /* remove newline */
+    parse_options(argc, argv, &opts);
 
-    if (strstr(line, "fatal: not a git repository") != NULL) {
-        fprintf(stderr, "Not a git repository\n");
-        exit(EXIT_SUCCESS);
-    }
-
-    if (!find_git_root(git_root, sizeof(git_root))) {
-        fprintf(stderr, "Cannot find git root\n");
-        exit(EXIT_SUCCESS);
-    }
+    gs_arena_init(&arena, arena_buffer, sizeof(arena_buffer));
 
-    snprintf(head_file, sizeof(head_file), "%s/HEAD", git_root);
-    snprintf(stash_file, sizeof(stash_file), "%s/logs/refs/stash", git_root);
-    snprintf(merge_file, sizeof(merge_file), "%s/MERGE_HEAD", git_root);
-    snprintf(rebase_dir, sizeof(rebase_dir), "%s/rebase-apply", git_root);
+    if (opts.report)
+        return report(opts.log, opts.threshold, &arena);
 
-    parse_branch(line, head_file, branch, upstream, &local);
-    ahead = parse_ahead_behind(line, "ahead ");
-    behind = parse_ahead_behind(line, "behind ");
-    stashes = stash_count(stash_file);
-    merge = is_file(merge_file);
-    rebase_progress(rebase_dir, rebase, sizeof(rebase));
+    /* one directory per input line, one status per output line */
+    if (opts.batch) {
+        while (fgets(batch_line, sizeof(batch_line), stdin) != NULL) {
+            batch_line[strcspn(batch_line, "\n")] = '\0';
+            print_status(batch_line, -1, &opts, &arena);
+            putchar('\n');
+            fflush(stdout);
+        }
 
-    while (fgets(line, sizeof(line), in) != NULL) {
-        parse_stat_line(line, &staged, &conflicts, &changed, &untracked);
+        return EXIT_SUCCESS;
     }
 
-    printf("%s %d %d %d %d %d %d %d %d %s %d %s", branch, ahead, behind, staged, conflicts, changed, untracked, stashes,
-           local, upstream, merge, rebase);
+    /* read a status piped or redirected in, otherwise run git ourselves */
+    if (fstat(0, &in_stat) == 0 && (S_ISFIFO(in_stat.st_mode) || S_ISREG(in_stat.st_mode)))
+        print_status(NULL, 0, &opts, &arena);
+    else
+        print_status(NULL, -1, &opts, &arena);
 
     return EXIT_SUCCESS;
 }
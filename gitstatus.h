@@ -0,0 +1,122 @@
+#ifndef GITSTATUS_H
+#define GITSTATUS_H
+
+#include <stddef.h>
+
+/* enough for gs_collect with the default options and a few dozen submodules */
+#define GS_ARENA_SIZE (256 * 1024)
+
+#define GS_OK 0
+#define GS_NOT_A_REPO 1
+#define GS_NO_GIT_ROOT 2
+#define GS_ERROR 3
+
+#define GS_AB_NONE 0
+#define GS_AB_HIT 1
+#define GS_AB_MISS 2
+#define GS_AB_APPROX 3
+
+#define GS_REPO_SPARSE 1
+#define GS_REPO_CONE 2
+#define GS_REPO_SPARSE_INDEX 4
+#define GS_REPO_PARTIAL 8
+
+#define GS_OP_NONE 0
+#define GS_OP_MERGE 1
+#define GS_OP_REBASE 2
+#define GS_OP_AM 3
+#define GS_OP_CHERRY_PICK 4
+#define GS_OP_REVERT 5
+#define GS_OP_BISECT 6
+
+#define GS_SUBMODULES_DEFAULT 0
+#define GS_SUBMODULES_IGNORE 1
+#define GS_SUBMODULES_DIRTY 2
+#define GS_SUBMODULES_FULL 3
+
+/*
+ * Caller supplied memory. Everything gs_collect needs, from path buffers to
+ * the returned branch names, is carved out of it, so one arena reset between
+ * calls is all the cleanup there is.
+ */
+struct gs_arena {
+    char *base;
+    size_t size;
+    size_t used;
+};
+
+struct gs_options {
+    int submodules;
+    int jobs;
+    int submodule_timeout; /* milliseconds, 0 means no cap */
+    int ab_cache;
+    int ab_timeout; /* milliseconds before the count moves to the background */
+    int fetch_interval; /* seconds between background fetches, 0 means never */
+    int fetch_jobs;     /* background fetches running at once across all processes */
+    const char *untracked_prune; /* comma separated directory names git does not walk for untracked files */
+    int untracked_max_depth;     /* levels searched for directories to prune, 0 turns pruning off */
+};
+
+struct gs_submodules {
+    int dirty;
+    int staged;
+    int conflicts;
+    int changed;
+    int untracked;
+    int timeout;
+};
+
+struct gs_status {
+    const char *branch; /* not NUL terminated, see branch_len */
+    size_t branch_len;
+    const char *upstream;
+    size_t upstream_len;
+    const char *root; /* top of the working tree */
+    size_t root_len;
+    long files; /* index entries, -1 when unknown */
+    int ahead;
+    int behind;
+    int staged;
+    int conflicts;
+    int changed;
+    int untracked;
+    int stashes;
+    int local;
+    int merge;
+    int op;
+    int op_step; /* -1 when there is no progress to report */
+    int op_total;
+    int mode;
+    int ab_state;
+    int submodules_mode;
+    struct gs_submodules submodules;
+};
+
+void gs_arena_init(struct gs_arena *arena, void *base, size_t size);
+void gs_arena_reset(struct gs_arena *arena);
+void *gs_alloc(struct gs_arena *arena, size_t size);
+
+void gs_options_init(struct gs_options *opts);
+void gs_status_init(struct gs_status *st);
+
+int gs_parse_branch(struct gs_arena *arena, const char *line, size_t len, int git_fd, struct gs_status *st);
+void gs_parse_stat_line(const char *line, size_t len, struct gs_status *st);
+
+/*
+ * Collect the status of the repository containing dir (the CWD when NULL).
+ * The porcelain status is read from in_fd, or from a git status run here
+ * when in_fd is -1. Returns one of the GS_ codes above.
+ */
+int gs_collect(const char *dir, int in_fd, const struct gs_options *opts, struct gs_arena *arena,
+               struct gs_status *st);
+
+/* "merge", "rebase", ... for a GS_OP_ code, NULL for GS_OP_NONE */
+const char *gs_op_name(int op);
+
+/* snprintf-like: "cone+sparse-index", "partial", ... for GS_REPO_ flags */
+int gs_mode_name(int mode, char *out, size_t len);
+
+/* snprintf-like: the gitstatus output line, without a trailing newline */
+int gs_format(const struct gs_status *st, char *out, size_t len);
+
+#endif
@@ -0,0 +1,496 @@
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <structmember.h>
+
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "gitstatus.h"
+
+#define DEFAULT_THREADS 8
+
+typedef struct {
+    PyObject_HEAD
+    struct gs_status st;
+    char *strings; /* branch, upstream and root, st points into it */
+} StatusObject;
+
+/* one path of a status_many call, filled without the GIL */
+struct request {
+    const char *path;
+    int ret;
+    struct gs_status st;
+    char *strings;
+};
+
+struct pool {
+    pthread_mutex_t lock;
+    struct request *requests;
+    Py_ssize_t count;
+    Py_ssize_t next;
+    const struct gs_options *opts;
+};
+
+struct worker {
+    pthread_t thread;
+    struct pool *pool;
+    struct gs_arena arena;
+};
+
+static PyTypeObject StatusType;
+
+/* copy the arena backed strings out, as the arena is reset for the next path */
+static void collect(const char *path, const struct gs_options *opts, struct gs_arena *arena, struct request *req)
+{
+    gs_arena_reset(arena);
+
+    req->strings = NULL;
+    req->ret = gs_collect(path, -1, opts, arena, &req->st);
+
+    if (req->ret != GS_OK)
+        return;
+
+    if ((req->strings = malloc(req->st.branch_len + req->st.upstream_len + req->st.root_len + 1)) == NULL) {
+        req->ret = GS_ERROR;
+        return;
+    }
+
+    memcpy(req->strings, req->st.branch, req->st.branch_len);
+    memcpy(req->strings + req->st.branch_len, req->st.upstream, req->st.upstream_len);
+    memcpy(req->strings + req->st.branch_len + req->st.upstream_len, req->st.root, req->st.root_len);
+    req->st.branch = req->strings;
+    req->st.upstream = req->strings + req->st.branch_len;
+    req->st.root = req->strings + req->st.branch_len + req->st.upstream_len;
+}
+
+static void *pool_worker(void *arg)
+{
+    struct worker *worker = arg;
+    struct pool *pool = worker->pool;
+    Py_ssize_t i;
+
+    for (;;) {
+        pthread_mutex_lock(&pool->lock);
+        i = pool->next < pool->count ? pool->next++ : -1;
+        pthread_mutex_unlock(&pool->lock);
+
+        if (i < 0)
+            break;
+
+        collect(pool->requests[i].path, pool->opts, &worker->arena, &pool->requests[i]);
+    }
+
+    return NULL;
+}
+
+/* an owned Status, None when the path is not in a repository, NULL with an exception set */
+static PyObject *status_from_request(struct request *req)
+{
+    StatusObject *self;
+
+    if (req->ret == GS_NOT_A_REPO || req->ret == GS_NO_GIT_ROOT)
+        Py_RETURN_NONE;
+
+    if (req->ret != GS_OK) {
+        PyErr_Format(PyExc_OSError, "Cannot run git in %s", req->path != NULL ? req->path : ".");
+        return NULL;
+    }
+
+    if ((self = PyObject_New(StatusObject, &StatusType)) == NULL)
+        return NULL;
+
+    self->st = req->st;
+    self->strings = req->strings;
+    req->strings = NULL;
+
+    return (PyObject *)self;
+}
+
+static int parse_options(const char *value, struct gs_options *opts)
+{
+    if (value == NULL || strcmp(value, "default") == 0)
+        opts->submodules = GS_SUBMODULES_DEFAULT;
+    else if (strcmp(value, "ignore") == 0)
+        opts->submodules = GS_SUBMODULES_IGNORE;
+    else if (strcmp(value, "dirty") == 0)
+        opts->submodules = GS_SUBMODULES_DIRTY;
+    else if (strcmp(value, "full") == 0)
+        opts->submodules = GS_SUBMODULES_FULL;
+    else {
+        PyErr_Format(PyExc_ValueError, "submodules must be default, ignore, dirty or full, not %s", value);
+        return 0;
+    }
+
+    if (opts->jobs < 1 || opts->fetch_jobs < 1 || opts->submodule_timeout < 0 || opts->ab_timeout < 0 ||
+        opts->fetch_interval < 0 || opts->untracked_max_depth < 0) {
+        PyErr_SetString(PyExc_ValueError, "jobs must be positive, timeouts, intervals and depths not negative");
+        return 0;
+    }
+
+    return 1;
+}
+
+static void Status_dealloc(StatusObject *self)
+{
+    free(self->strings);
+    PyObject_Del(self);
+}
+
+static PyObject *Status_str(StatusObject *self)
+{
+    PyObject *str;
+    char *out;
+    int len;
+
+    len = gs_format(&self->st, NULL, 0);
+
+    if ((out = PyMem_Malloc(len + 1)) == NULL)
+        return PyErr_NoMemory();
+
+    gs_format(&self->st, out, len + 1);
+    str = PyUnicode_DecodeFSDefaultAndSize(out, len);
+    PyMem_Free(out);
+
+    return str;
+}
+
+static PyObject *Status_repr(StatusObject *self)
+{
+    PyObject *str, *repr;
+
+    if ((str = Status_str(self)) == NULL)
+        return NULL;
+
+    repr = PyUnicode_FromFormat("<_gitstatus.Status %R>", str);
+    Py_DECREF(str);
+
+    return repr;
+}
+
+static PyObject *Status_get_branch(StatusObject *self, void *closure)
+{
+    (void)closure;
+    return PyUnicode_DecodeFSDefaultAndSize(self->st.branch, self->st.branch_len);
+}
+
+static PyObject *Status_get_upstream(StatusObject *self, void *closure)
+{
+    (void)closure;
+    if (self->st.local)
+        Py_RETURN_NONE;
+    return PyUnicode_DecodeFSDefaultAndSize(self->st.upstream, self->st.upstream_len);
+}
+
+static PyObject *Status_get_root(StatusObject *self, void *closure)
+{
+    (void)closure;
+    return PyUnicode_DecodeFSDefaultAndSize(self->st.root, self->st.root_len);
+}
+
+static PyObject *Status_get_local(StatusObject *self, void *closure)
+{
+    (void)closure;
+    return PyBool_FromLong(self->st.local);
+}
+
+static PyObject *Status_get_op(StatusObject *self, void *closure)
+{
+    const char *name = gs_op_name(self->st.op);
+
+    (void)closure;
+    if (name == NULL)
+        Py_RETURN_NONE;
+    return PyUnicode_FromString(name);
+}
+
+static PyObject *Status_get_op_progress(StatusObject *self, void *closure)
+{
+    (void)closure;
+    if (self->st.op == GS_OP_NONE || self->st.op_step < 0)
+        Py_RETURN_NONE;
+    return Py_BuildValue("(ii)", self->st.op_step, self->st.op_total);
+}
+
+static PyObject *Status_get_mode(StatusObject *self, void *closure)
+{
+    char mode[48];
+
+    (void)closure;
+    if (self->st.mode == 0)
+        Py_RETURN_NONE;
+    gs_mode_name(self->st.mode, mode, sizeof(mode));
+    return PyUnicode_FromString(mode);
+}
+
+static PyObject *Status_get_ab_approx(StatusObject *self, void *closure)
+{
+    (void)closure;
+    return PyBool_FromLong(self->st.ab_state == GS_AB_APPROX);
+}
+
+/* a dict of the submodule counts the chosen mode reports, None when submodules were not walked */
+static PyObject *Status_get_submodules(StatusObject *self, void *closure)
+{
+    const struct gs_submodules *sm = &self->st.submodules;
+
+    (void)closure;
+    if (self->st.submodules_mode == GS_SUBMODULES_FULL)
+        return Py_BuildValue("{sisisisisisi}", "dirty", sm->dirty, "staged", sm->staged, "conflicts",
+                             sm->conflicts, "changed", sm->changed, "untracked", sm->untracked, "timeout",
+                             sm->timeout);
+    if (self->st.submodules_mode == GS_SUBMODULES_DIRTY)
+        return Py_BuildValue("{sisi}", "dirty", sm->dirty, "timeout", sm->timeout);
+    Py_RETURN_NONE;
+}
+
+static PyMemberDef Status_members[] = {
+    {"ahead", T_INT, offsetof(StatusObject, st.ahead), READONLY, "Commits ahead of the upstream."},
+    {"behind", T_INT, offsetof(StatusObject, st.behind), READONLY, "Commits behind the upstream."},
+    {"staged", T_INT, offsetof(StatusObject, st.staged), READONLY, "Staged files."},
+    {"conflicts", T_INT, offsetof(StatusObject, st.conflicts), READONLY, "Files with conflicts."},
+    {"changed", T_INT, offsetof(StatusObject, st.changed), READONLY, "Changed files not staged."},
+    {"untracked", T_INT, offsetof(StatusObject, st.untracked), READONLY, "Untracked files."},
+    {"stashes", T_INT, offsetof(StatusObject, st.stashes), READONLY, "Stash entries."},
+    {"files", T_LONG, offsetof(StatusObject, st.files), READONLY, "Entries in the index, -1 when unknown."},
+    {NULL, 0, 0, 0, NULL},
+};
+
+static PyGetSetDef Status_getset[] = {
+    {"branch", (getter)Status_get_branch, NULL, "Branch name, or :hash on a detached HEAD.", NULL},
+    {"upstream", (getter)Status_get_upstream, NULL, "Upstream branch, None for a local branch.", NULL},
+    {"root", (getter)Status_get_root, NULL, "Top of the working tree.", NULL},
+    {"local", (getter)Status_get_local, NULL, "True when the branch has no upstream.", NULL},
+    {"op", (getter)Status_get_op, NULL, "The operation in progress (merge, rebase, ...) or None.", NULL},
+    {"op_progress", (getter)Status_get_op_progress, NULL, "(step, total) of the operation, or None.", NULL},
+    {"mode", (getter)Status_get_mode, NULL, "Sparse/partial layout such as cone+sparse-index, or None.", NULL},
+    {"ab_approx", (getter)Status_get_ab_approx, NULL, "True when ahead/behind are the last known counts.", NULL},
+    {"submodules", (getter)Status_get_submodules, NULL, "Submodule counts, or None.", NULL},
+    {NULL, NULL, NULL, NULL, NULL},
+};
+
+static PyTypeObject StatusType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_gitstatus.Status",
+    .tp_basicsize = sizeof(StatusObject),
+    .tp_dealloc = (destructor)Status_dealloc,
+    .tp_repr = (reprfunc)Status_repr,
+    .tp_str = (reprfunc)Status_str,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_doc = "Status of one repository, str() gives the gitstatus output line.",
+    .tp_members = Status_members,
+    .tp_getset = Status_getset,
+};
+
+static PyObject *gitstatus_status(PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"path", "submodules", "jobs", "submodule_timeout", "ahead_behind_cache",
+                               "ahead_behind_timeout", "fetch_interval", "fetch_jobs", "untracked_prune",
+                               "untracked_max_depth", NULL};
+    struct gs_options opts;
+    struct gs_arena arena;
+    struct request req;
+    const char *submodules = NULL;
+    PyObject *path_arg = Py_None, *path = NULL, *result;
+    char *buffer;
+
+    (void)module;
+    gs_options_init(&opts);
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|O$ziipiiizi:status", keywords, &path_arg,
+                                     &submodules, &opts.jobs, &opts.submodule_timeout, &opts.ab_cache,
+                                     &opts.ab_timeout, &opts.fetch_interval, &opts.fetch_jobs,
+                                     &opts.untracked_prune, &opts.untracked_max_depth))
+        return NULL;
+
+    if (!parse_options(submodules, &opts))
+        return NULL;
+
+    if (path_arg != Py_None && !PyUnicode_FSConverter(path_arg, &path))
+        return NULL;
+
+    if ((buffer = PyMem_RawMalloc(GS_ARENA_SIZE)) == NULL) {
+        Py_XDECREF(path);
+        return PyErr_NoMemory();
+    }
+
+    gs_arena_init(&arena, buffer, GS_ARENA_SIZE);
+    req.path = path != NULL ? PyBytes_AS_STRING(path) : NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    collect(req.path, &opts, &arena, &req);
+    Py_END_ALLOW_THREADS
+
+    PyMem_RawFree(buffer);
+
+    result = status_from_request(&req);
+    free(req.strings);
+    Py_XDECREF(path);
+
+    return result;
+}
+
+static PyObject *gitstatus_status_many(PyObject *module, PyObject *args, PyObject *kwargs)
+{
+    static char *keywords[] = {"paths", "threads", "submodules", "jobs", "submodule_timeout", "ahead_behind_cache",
+                               "ahead_behind_timeout", "fetch_interval", "fetch_jobs", "untracked_prune",
+                               "untracked_max_depth", NULL};
+    struct gs_options opts;
+    struct request *requests = NULL;
+    struct worker *workers = NULL;
+    struct pool pool;
+    const char *submodules = NULL;
+    PyObject *paths, *seq = NULL, *bytes = NULL, *result = NULL, *item;
+    Py_ssize_t i, count;
+    int threads = DEFAULT_THREADS, started = 0;
+
+    (void)module;
+    gs_options_init(&opts);
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|$iziipiiizi:status_many", keywords, &paths, &threads,
+                                     &submodules, &opts.jobs, &opts.submodule_timeout, &opts.ab_cache,
+                                     &opts.ab_timeout, &opts.fetch_interval, &opts.fetch_jobs,
+                                     &opts.untracked_prune, &opts.untracked_max_depth))
+        return NULL;
+
+    if (!parse_options(submodules, &opts))
+        return NULL;
+
+    if (threads < 1) {
+        PyErr_SetString(PyExc_ValueError, "threads must be positive");
+        return NULL;
+    }
+
+    /* a single path is iterable too, one status per character is never what was meant */
+    if (PyUnicode_Check(paths) || PyBytes_Check(paths) || PyByteArray_Check(paths)) {
+        PyErr_SetString(PyExc_TypeError, "paths must be an iterable of paths, not a single path");
+        return NULL;
+    }
+
+    if ((seq = PySequence_Fast(paths, "paths must be an iterable")) == NULL)
+        return NULL;
+
+    count = PySequence_Fast_GET_SIZE(seq);
+    if (threads > count)
+        threads = count > 0 ? (int)count : 1;
+
+    if ((bytes = PyList_New(count)) == NULL)
+        goto done;
+
+    requests = PyMem_Calloc(count > 0 ? count : 1, sizeof(*requests));
+    workers = PyMem_Calloc(threads, sizeof(*workers));
+    if (requests == NULL || workers == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    for (i = 0; i < count; i++) {
+        if (!PyUnicode_FSConverter(PySequence_Fast_GET_ITEM(seq, i), &item))
+            goto done;
+        PyList_SET_ITEM(bytes, i, item);
+        requests[i].path = PyBytes_AS_STRING(item);
+    }
+
+    for (i = 0; i < threads; i++) {
+        if ((workers[i].arena.base = PyMem_RawMalloc(GS_ARENA_SIZE)) == NULL) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        gs_arena_init(&workers[i].arena, workers[i].arena.base, GS_ARENA_SIZE);
+        workers[i].pool = &pool;
+    }
+
+    pthread_mutex_init(&pool.lock, NULL);
+    pool.requests = requests;
+    pool.count = count;
+    pool.next = 0;
+    pool.opts = &opts;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < threads; i++) {
+        if (pthread_create(&workers[i].thread, NULL, pool_worker, &workers[i]) != 0)
+            break;
+        started++;
+    }
+
+    /* no thread could start, collect everything here */
+    if (started == 0)
+        pool_worker(&workers[0]);
+
+    for (i = 0; i < started; i++)
+        pthread_join(workers[i].thread, NULL);
+    Py_END_ALLOW_THREADS
+
+    pthread_mutex_destroy(&pool.lock);
+
+    if ((result = PyList_New(count)) == NULL)
+        goto done;
+
+    for (i = 0; i < count; i++) {
+        if ((item = status_from_request(&requests[i])) == NULL) {
+            Py_CLEAR(result);
+            goto done;
+        }
+        PyList_SET_ITEM(result, i, item);
+    }
+
+done:
+    if (requests != NULL) {
+        for (i = 0; i < count; i++)
+            free(requests[i].strings);
+        PyMem_Free(requests);
+    }
+    if (workers != NULL) {
+        for (i = 0; i < threads; i++)
+            PyMem_RawFree(workers[i].arena.base);
+        PyMem_Free(workers);
+    }
+    Py_XDECREF(bytes);
+    Py_DECREF(seq);
+
+    return result;
+}
+
+static PyMethodDef gitstatus_methods[] = {
+    {"status", (PyCFunction)(void (*)(void))gitstatus_status, METH_VARARGS | METH_KEYWORDS,
+     "status(path=None, *, submodules=None, jobs=8, submodule_timeout=500,\n"
+     "       ahead_behind_cache=False, ahead_behind_timeout=100,\n"
+     "       fetch_interval=0, fetch_jobs=2, untracked_prune=None,\n"
+     "       untracked_max_depth=3)\n\n"
+     "The Status of the repository containing path (the CWD by default), or\n"
+     "None when it is not in a git repository. Options match the gitstatus\n"
+     "command line."},
+    {"status_many", (PyCFunction)(void (*)(void))gitstatus_status_many, METH_VARARGS | METH_KEYWORDS,
+     "status_many(paths, *, threads=8, **options)\n\n"
+     "A list with the status(path, **options) of every path, collected by up\n"
+     "to threads threads with the GIL released."},
+    {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef gitstatus_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "_gitstatus",
+    .m_doc = "Binding to the gitstatus C library.",
+    .m_size = -1,
+    .m_methods = gitstatus_methods,
+};
+
+PyMODINIT_FUNC PyInit__gitstatus(void)
+{
+    PyObject *module;
+
+    if (PyType_Ready(&StatusType) < 0)
+        return NULL;
+
+    if ((module = PyModule_Create(&gitstatus_module)) == NULL)
+        return NULL;
+
+    Py_INCREF(&StatusType);
+    if (PyModule_AddObject(module, "Status", (PyObject *)&StatusType) < 0) {
+        Py_DECREF(&StatusType);
+        Py_DECREF(module);
+        return NULL;
+    }
+
+    return module;
+}
@@ -0,0 +1,1700 @@
+#define _DEFAULT_SOURCE
+#include <stdio.h>
+#include <stdlib.h>
+#include <ctype.h>
+#include <dirent.h>
+#include <fnmatch.h>
+#include <string.h>
+#include <strings.h>
+#include <unistd.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <pthread.h>
+#include <signal.h>
+#include <spawn.h>
+#include <time.h>
+#include <sys/file.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <sys/wait.h>
+
+#include "gitstatus.h"
+
+#define MAX_PATH_LENGTH 4096
+#define MAX_NAME_LENGTH 256
+#define MAX_GIT_ARGS 80
+#define MAX_GIT_ENV 2048
+#define MAX_OID_LENGTH 72
+#define MAX_REF_DEPTH 5
+#define LINE_BUFFER 4096
+#define STATUS_BUFFER 8192
+
+#define AB_CACHE_FILE "gitstatus-ahead-behind"
+#define AB_LOCK_FILE "gitstatus-ahead-behind.lock"
+#define AB_CACHE_SIZE 32
+
+#define FETCH_STAMP_FILE "gitstatus-fetch"
+#define FETCH_LOCK_FILE "gitstatus-fetch.lock"
+#define FETCH_TIMEOUT 300 /* seconds before a hung background fetch is killed */
+
+#define MAX_PRUNE_PATTERNS 8
+#define MAX_PRUNED_DIRS 64
+
+/* buffered line reader over a file descriptor, with an optional deadline */
+struct reader {
+    int fd;
+    char *buf;
+    size_t size;
+    size_t start;
+    size_t end;
+    long deadline; /* now_ms() based, 0 means wait forever */
+    int eof;
+    int skip;
+    int timeout;
+};
+
+struct repo {
+    char *git_root;
+    char *common;
+    char *top;
+    int git_fd;
+    int common_fd;
+};
+
+struct ahead_behind {
+    char local[MAX_OID_LENGTH];
+    char upstream[MAX_OID_LENGTH];
+    int ahead;
+    int behind;
+    char name[MAX_NAME_LENGTH];
+};
+
+/* untracked directories git is told not to walk, see --untracked-prune */
+struct prune {
+    char *patterns[MAX_PRUNE_PATTERNS];
+    int count;
+    char *dirs[MAX_PRUNED_DIRS]; /* found under the top, relative to it */
+    int found;
+    int listed; /* how many of them git lists as untracked */
+};
+
+struct submodule {
+    char *path;
+    struct gs_submodules counts;
+    struct submodule *next;
+};
+
+struct submodule_pool {
+    struct submodule *next;
+    int mode;
+    int timeout;
+    pthread_mutex_t lock;
+};
+
+struct submodule_worker {
+    struct submodule_pool *pool;
+    char *buf;
+    pthread_t thread;
+};
+
+static const char *operation_names[] = {"", "merge", "rebase", "am", "cherry-pick", "revert", "bisect"};
+
+static pthread_mutex_t spawn_lock = PTHREAD_MUTEX_INITIALIZER;
+
+extern char **environ;
+
+void gs_arena_init(struct gs_arena *arena, void *base, size_t size)
+{
+    arena->base = base;
+    arena->size = size;
+    arena->used = 0;
+}
+
+void gs_arena_reset(struct gs_arena *arena)
+{
+    arena->used = 0;
+}
+
+void *gs_alloc(struct gs_arena *arena, size_t size)
+{
+    size_t start = (arena->used + 15) & ~(size_t)15;
+
+    if (start > arena->size || arena->size - start < size)
+        return NULL;
+
+    arena->used = start + size;
+
+    return arena->base + start;
+}
+
+static char *arena_strndup(struct gs_arena *arena, const char *s, size_t len)
+{
+    char *copy;
+
+    if ((copy = gs_alloc(arena, len + 1)) == NULL)
+        return NULL;
+
+    memcpy(copy, s, len);
+    copy[len] = '\0';
+
+    return copy;
+}
+
+void gs_options_init(struct gs_options *opts)
+{
+    opts->submodules = GS_SUBMODULES_DEFAULT;
+    opts->jobs = 8;
+    opts->submodule_timeout = 500;
+    opts->ab_cache = 0;
+    opts->ab_timeout = 100;
+    opts->fetch_interval = 0;
+    opts->fetch_jobs = 2;
+    opts->untracked_prune = NULL;
+    opts->untracked_max_depth = 3;
+}
+
+void gs_status_init(struct gs_status *st)
+{
+    memset(st, 0, sizeof(*st));
+    st->branch = "";
+    st->upstream = "..";
+    st->upstream_len = 2;
+    st->root = "";
+    st->files = -1;
+    st->local = 1;
+    st->op_step = -1;
+    st->op_total = -1;
+}
+
+static long now_ms(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+
+    return ts.tv_sec * 1000L + ts.tv_nsec / 1000000L;
+}
+
+static const char *find(const char *s, size_t len, const char *what)
+{
+    const char *end = s + len;
+    size_t n = strlen(what);
+
+    while (s != NULL && (size_t)(end - s) >= n) {
+        if (memcmp(s, what, n) == 0)
+            return s;
+        s = memchr(s + 1, what[0], end - s - 1);
+    }
+
+    return NULL;
+}
+
+static int is_directory(const char *path)
+{
+    struct stat path_stat;
+
+    if (stat(path, &path_stat) != 0)
+        return 0;
+
+    return S_ISDIR(path_stat.st_mode);
+}
+
+static int is_file(const char *path)
+{
+    struct stat path_stat;
+
+    if (stat(path, &path_stat) != 0)
+        return 0;
+
+    return S_ISREG(path_stat.st_mode);
+}
+
+static int is_at(int dir_fd, const char *path, int mode)
+{
+    struct stat path_stat;
+
+    if (fstatat(dir_fd, path, &path_stat, 0) != 0)
+        return 0;
+
+    return (path_stat.st_mode & S_IFMT) == (unsigned)mode;
+}
+
+static int open_at(int dir_fd, const char *path)
+{
+    return openat(dir_fd, path, O_RDONLY | O_CLOEXEC);
+}
+
+static void reader_init(struct reader *r, int fd, char *buf, size_t size, long deadline)
+{
+    r->fd = fd;
+    r->buf = buf;
+    r->size = size;
+    r->start = 0;
+    r->end = 0;
+    r->deadline = deadline;
+    r->eof = 0;
+    r->skip = 0;
+    r->timeout = 0;
+}
+
+/*
+ * Return the length of the next line, NUL terminated in place, or -1 at the
+ * end of input or on timeout. Lines longer than the buffer are truncated.
+ */
+static long read_line(struct reader *r, char **line)
+{
+    struct pollfd pfd;
+    long remaining = -1;
+    size_t len;
+    ssize_t n;
+    char *nl;
+
+    for (;;) {
+        nl = memchr(r->buf + r->start, '\n', r->end - r->start);
+
+        if (r->skip) {
+            if (nl != NULL) {
+                r->start = nl + 1 - r->buf;
+                r->skip = 0;
+                continue;
+            }
+            r->start = r->end = 0;
+        } else if (nl != NULL || r->eof || (r->start == 0 && r->end == r->size - 1)) {
+            if (nl == NULL && r->start == r->end)
+                return -1;
+
+            *line = r->buf + r->start;
+
+            if (nl != NULL) {
+                len = nl - *line;
+                r->start += len + 1;
+            } else {
+                len = r->end - r->start;
+                r->start = r->end;
+                r->skip = !r->eof;
+            }
+
+            (*line)[len] = '\0';
+
+            return (long)len;
+        }
+
+        if (r->eof)
+            return -1;
+
+        if (r->start > 0) {
+            memmove(r->buf, r->buf + r->start, r->end - r->start);
+            r->end -= r->start;
+            r->start = 0;
+        }
+
+        if (r->deadline > 0) {
+            if ((remaining = r->deadline - now_ms()) <= 0) {
+                r->timeout = 1;
+                return -1;
+            }
+
+            pfd.fd = r->fd;
+            pfd.events = POLLIN;
+
+            if ((n = poll(&pfd, 1, (int)remaining)) < 0 && errno == EINTR)
+                continue;
+            if (n == 0) {
+                r->timeout = 1;
+                return -1;
+            }
+        }
+
+        if ((n = read(r->fd, r->buf + r->end, r->size - 1 - r->end)) < 0 && errno == EINTR)
+            continue;
+
+        if (n <= 0)
+            r->eof = 1;
+        else
+            r->end += n;
+    }
+}
+
+static long read_first_line(struct gs_arena *arena, int dir_fd, const char *path, char **line)
+{
+    struct reader r;
+    char *buf;
+    long len;
+    int fd;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL || (fd = open_at(dir_fd, path)) < 0)
+        return -1;
+
+    reader_init(&r, fd, buf, LINE_BUFFER, 0);
+    len = read_line(&r, line);
+    close(fd);
+
+    return len;
+}
+
+static int read_number_at(struct gs_arena *arena, int dir_fd, const char *path)
+{
+    size_t mark = arena->used;
+    char *line;
+    int value = -1;
+
+    if (read_first_line(arena, dir_fd, path, &line) > 0 && isdigit((unsigned char)line[0]))
+        value = atoi(line);
+
+    arena->used = mark;
+
+    return value;
+}
+
+/* from the index header, which is cheaper than any walk of the tree */
+static long index_entries(int git_fd)
+{
+    unsigned char header[12];
+    int fd;
+
+    if ((fd = open_at(git_fd, "index")) < 0)
+        return -1;
+
+    if (read(fd, header, sizeof(header)) != sizeof(header) || memcmp(header, "DIRC", 4) != 0) {
+        close(fd);
+        return -1;
+    }
+
+    close(fd);
+
+    return ((long)header[8] << 24) | ((long)header[9] << 16) | ((long)header[10] << 8) | (long)header[11];
+}
+
+static int stash_count(struct gs_arena *arena, int dir_fd)
+{
+    size_t mark = arena->used;
+    char *buf;
+    ssize_t n, i;
+    int stashes = 0;
+    int fd;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL || (fd = open_at(dir_fd, "logs/refs/stash")) < 0) {
+        arena->used = mark;
+        return 0;
+    }
+
+    while ((n = read(fd, buf, LINE_BUFFER)) > 0 || (n < 0 && errno == EINTR))
+        for (i = 0; i < n; i++)
+            if (buf[i] == '\n')
+                stashes++;
+
+    close(fd);
+    arena->used = mark;
+
+    return stashes;
+}
+
+static int parse_ahead_behind(const char *line, size_t len, const char *what)
+{
+    const char *pos, *end = line + len;
+    int value = 0;
+
+    pos = find(line, len, what);
+
+    if (pos != NULL) {
+        for (pos += strlen(what); pos < end && isdigit((unsigned char)*pos); pos++) {
+            value = value * 10 + *pos - '0';
+        }
+    }
+
+    return value;
+}
+
+int gs_parse_branch(struct gs_arena *arena, const char *line, size_t len, int git_fd, struct gs_status *st)
+{
+    const char *end = line + len;
+    const char *p, *q;
+    char head[8];
+    ssize_t n;
+    int fd;
+
+    if (find(line, len, "no branch") != NULL) {
+        st->local = 0;
+
+        if (git_fd >= 0 && (fd = open_at(git_fd, "HEAD")) >= 0) {
+            n = read(fd, head + 1, 7);
+            close(fd);
+            head[0] = ':';
+            st->branch_len = n > 0 ? n + 1 : 1;
+            st->branch = arena_strndup(arena, head, st->branch_len);
+        }
+    } else if (find(line, len, "Initial commit") != NULL || find(line, len, "No commits yet") != NULL) {
+        for (p = end; p > line && p[-1] != ' '; p--)
+            ;
+        st->branch_len = end - p;
+        st->branch = arena_strndup(arena, p, st->branch_len);
+    } else {
+        p = len > 3 ? line + 3 : end;
+        q = find(p, end - p, "..");
+        st->branch_len = (q != NULL ? q : end) - p;
+        st->branch = arena_strndup(arena, p, st->branch_len);
+
+        if (q != NULL && q + 2 < end && q[2] == '.') {
+            st->local = 0;
+
+            for (p = q += 3; q < end && *q != '\n' && *q != ' ' && *q != '['; q++)
+                ;
+            st->upstream_len = q - p;
+            st->upstream = arena_strndup(arena, p, st->upstream_len);
+        }
+    }
+
+    if (st->branch == NULL || st->upstream == NULL)
+        return -1;
+
+    st->ahead = parse_ahead_behind(line, len, "ahead ");
+    st->behind = parse_ahead_behind(line, len, "behind ");
+
+    return 0;
+}
+
+static void count_stat_line(const char *line, int *staged, int *conflicts, int *changed, int *untracked)
+{
+    if (line[0] == '?' && line[1] == '?')
+        ++*untracked;
+
+    if ((line[0] == 'A' && (line[1] == 'A' || line[1] == 'D')) ||
+        (line[0] == 'D' && (line[1] == 'D' || line[1] == 'U')) ||
+        (line[0] == 'U' && (line[1] == 'A' || line[1] == 'D' || line[1] == 'U')))
+        ++*conflicts;
+
+    if (line[0] == 'A' || line[0] == 'C' || line[0] == 'D' || line[0] == 'M' || line[0] == 'R')
+        ++*staged;
+    if (line[1] == 'C' || line[1] == 'D' || line[1] == 'M' || line[1] == 'R')
+        ++*changed;
+}
+
+void gs_parse_stat_line(const char *line, size_t len, struct gs_status *st)
+{
+    char code[2];
+
+    code[0] = len > 0 ? line[0] : '\0';
+    code[1] = len > 1 ? line[1] : '\0';
+
+    count_stat_line(code, &st->staged, &st->conflicts, &st->changed, &st->untracked);
+}
+
+static int find_git_root(struct gs_arena *arena, const char *dir, struct repo *repo)
+{
+    size_t mark, n;
+    char *line, *p, *slash;
+
+    repo->top = gs_alloc(arena, MAX_PATH_LENGTH);
+    repo->git_root = gs_alloc(arena, MAX_PATH_LENGTH);
+    repo->common = gs_alloc(arena, MAX_PATH_LENGTH);
+
+    if (repo->top == NULL || repo->git_root == NULL || repo->common == NULL)
+        return 0;
+
+    if (dir == NULL || dir[0] != '/') {
+        if (getcwd(repo->top, MAX_PATH_LENGTH) == NULL)
+            return 0;
+        n = strlen(repo->top);
+        if (dir != NULL)
+            snprintf(repo->top + n, MAX_PATH_LENGTH - n, "/%s", dir);
+    } else {
+        snprintf(repo->top, MAX_PATH_LENGTH, "%s", dir);
+    }
+
+    while (strcmp(repo->top, "/")) {
+        snprintf(repo->git_root, MAX_PATH_LENGTH, "%s/.git", repo->top);
+
+        if (is_directory(repo->git_root))
+            return 1;
+
+        if (is_file(repo->git_root)) {
+            mark = arena->used;
+
+            if (read_first_line(arena, AT_FDCWD, repo->git_root, &line) < 0 || strncmp(line, "gitdir:", 7)) {
+                arena->used = mark;
+                return 0;
+            }
+
+            for (p = line + 7; *p == ' '; p++)
+                ;
+            p[strcspn(p, " \r")] = '\0';
+
+            /* relative to the directory holding .git */
+            if (*p == '/')
+                snprintf(repo->git_root, MAX_PATH_LENGTH, "%s", p);
+            else
+                snprintf(repo->git_root, MAX_PATH_LENGTH, "%s/%s", repo->top, p);
+
+            arena->used = mark;
+
+            return 1;
+        }
+
+        if ((slash = strrchr(repo->top, '/')) == NULL)
+            return 0;
+        if (slash == repo->top)
+            slash[1] = '\0';
+        else
+            *slash = '\0';
+    }
+
+    return 0;
+}
+
+static void find_common_dir(struct gs_arena *arena, struct repo *repo)
+{
+    size_t mark = arena->used;
+    char *line;
+
+    snprintf(repo->common, MAX_PATH_LENGTH, "%s", repo->git_root);
+
+    /* linked worktrees share the config of the main repository */
+    if (read_first_line(arena, repo->git_fd, "commondir", &line) > 0) {
+        line[strcspn(line, "\r")] = '\0';
+        if (line[0] == '/')
+            snprintf(repo->common, MAX_PATH_LENGTH, "%s", line);
+        else
+            snprintf(repo->common, MAX_PATH_LENGTH, "%s/%s", repo->git_root, line);
+    }
+
+    arena->used = mark;
+}
+
+static int config_bool(const char *value)
+{
+    return value == NULL || !strcasecmp(value, "true") || !strcasecmp(value, "yes") || !strcasecmp(value, "on") ||
+           !strcmp(value, "1");
+}
+
+/* with untracked_all, status.showUntrackedFiles=all is also looked for */
+static int read_config_mode(struct gs_arena *arena, int dir_fd, const char *config_file, int mode, int *untracked_all)
+{
+    size_t mark = arena->used;
+    char section[MAX_NAME_LENGTH] = "";
+    char *line, *key, *value, *end;
+    struct reader r;
+    char *buf;
+    int fd;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL || (fd = open_at(dir_fd, config_file)) < 0) {
+        arena->used = mark;
+        return mode;
+    }
+
+    reader_init(&r, fd, buf, LINE_BUFFER, 0);
+
+    while (read_line(&r, &line) >= 0) {
+        for (key = line; isspace((unsigned char)*key); key++)
+            ;
+        for (end = key + strlen(key); end > key && isspace((unsigned char)end[-1]); end--)
+            ;
+        *end = '\0';
+
+        if (*key == '[') {
+            snprintf(section, sizeof(section), "%.*s", (int)strcspn(key + 1, "]"), key + 1);
+            continue;
+        }
+        if (*key == '\0' || *key == '#' || *key == ';')
+            continue;
+
+        value = NULL;
+        if ((end = strchr(key, '=')) != NULL) {
+            for (value = end + 1; isspace((unsigned char)*value); value++)
+                ;
+            for (; end > key && isspace((unsigned char)end[-1]); end--)
+                ;
+            *end = '\0';
+        }
+
+        if (!strcasecmp(section, "core") && !strcasecmp(key, "sparseCheckout")) {
+            mode = config_bool(value) ? mode | GS_REPO_SPARSE : mode & ~GS_REPO_SPARSE;
+        } else if (!strcasecmp(section, "core") && !strcasecmp(key, "sparseCheckoutCone")) {
+            mode = config_bool(value) ? mode | GS_REPO_CONE : mode & ~GS_REPO_CONE;
+        } else if (!strcasecmp(section, "index") && !strcasecmp(key, "sparse")) {
+            mode = config_bool(value) ? mode | GS_REPO_SPARSE_INDEX : mode & ~GS_REPO_SPARSE_INDEX;
+        } else if (!strcasecmp(section, "extensions") && !strcasecmp(key, "partialClone")) {
+            mode |= GS_REPO_PARTIAL;
+        } else if (!strncasecmp(section, "remote ", 7) && !strcasecmp(key, "promisor") && config_bool(value)) {
+            mode |= GS_REPO_PARTIAL;
+        } else if (untracked_all != NULL && !strcasecmp(section, "status") && !strcasecmp(key, "showUntrackedFiles")) {
+            *untracked_all = value != NULL && !strcasecmp(value, "all");
+        }
+    }
+
+    close(fd);
+    arena->used = mark;
+
+    return mode;
+}
+
+/* the user's config files, in the order git reads them, for the settings not tied to a repository */
+static void user_config(struct gs_arena *arena, int *untracked_all)
+{
+    const char *home = getenv("HOME"), *xdg = getenv("XDG_CONFIG_HOME"), *file;
+    size_t mark = arena->used;
+    char *path;
+
+    if ((path = gs_alloc(arena, MAX_PATH_LENGTH)) == NULL)
+        return;
+
+    if (getenv("GIT_CONFIG_NOSYSTEM") == NULL || !config_bool(getenv("GIT_CONFIG_NOSYSTEM")))
+        read_config_mode(arena, AT_FDCWD, (file = getenv("GIT_CONFIG_SYSTEM")) ? file : "/etc/gitconfig", 0,
+                         untracked_all);
+
+    if ((file = getenv("GIT_CONFIG_GLOBAL")) != NULL) {
+        read_config_mode(arena, AT_FDCWD, file, 0, untracked_all);
+    } else {
+        if (xdg != NULL && *xdg != '\0')
+            snprintf(path, MAX_PATH_LENGTH, "%s/git/config", xdg);
+        else
+            snprintf(path, MAX_PATH_LENGTH, "%s/.config/git/config", home ? home : "");
+        read_config_mode(arena, AT_FDCWD, path, 0, untracked_all);
+        snprintf(path, MAX_PATH_LENGTH, "%s/.gitconfig", home ? home : "");
+        read_config_mode(arena, AT_FDCWD, path, 0, untracked_all);
+    }
+
+    arena->used = mark;
+}
+
+/* with untracked_all, the user's config files are read first, see user_config */
+static int repo_mode(struct gs_arena *arena, struct repo *repo, int *untracked_all)
+{
+    int mode = 0;
+
+    if (untracked_all != NULL)
+        user_config(arena, untracked_all);
+
+    mode = read_config_mode(arena, repo->common_fd, "config", mode, untracked_all);
+    mode = read_config_mode(arena, repo->git_fd, "config.worktree", mode, untracked_all);
+
+    /* cone mode and the sparse index only apply to a sparse checkout */
+    if (!(mode & GS_REPO_SPARSE))
+        mode &= ~(GS_REPO_CONE | GS_REPO_SPARSE_INDEX);
+
+    return mode;
+}
+
+static void detect_operation(struct gs_arena *arena, int dir_fd, struct gs_status *st)
+{
+    st->op = GS_OP_NONE;
+    st->op_step = -1;
+    st->op_total = -1;
+    st->merge = is_at(dir_fd, "MERGE_HEAD", S_IFREG);
+
+    if (is_at(dir_fd, "rebase-merge", S_IFDIR)) {
+        st->op = GS_OP_REBASE;
+        st->op_step = read_number_at(arena, dir_fd, "rebase-merge/msgnum");
+        st->op_total = read_number_at(arena, dir_fd, "rebase-merge/end");
+    } else if (is_at(dir_fd, "rebase-apply", S_IFDIR)) {
+        st->op = is_at(dir_fd, "rebase-apply/applying", S_IFREG) ? GS_OP_AM : GS_OP_REBASE;
+        st->op_step = read_number_at(arena, dir_fd, "rebase-apply/next");
+        st->op_total = read_number_at(arena, dir_fd, "rebase-apply/last");
+    } else if (st->merge) {
+        st->op = GS_OP_MERGE;
+    } else if (is_at(dir_fd, "CHERRY_PICK_HEAD", S_IFREG)) {
+        st->op = GS_OP_CHERRY_PICK;
+    } else if (is_at(dir_fd, "REVERT_HEAD", S_IFREG)) {
+        st->op = GS_OP_REVERT;
+    } else if (is_at(dir_fd, "BISECT_LOG", S_IFREG)) {
+        st->op = GS_OP_BISECT;
+    }
+
+    if (st->op_step < 0 || st->op_total < 0)
+        st->op_step = st->op_total = -1;
+}
+
+/*
+ * A prompt must never wait on a promisor remote (git 2.44+) or on a password,
+ * nor take the index lock, which a git stopped at a time cap could leave behind.
+ */
+static char **git_environment(char **envp)
+{
+    static char *overrides[] = {"GIT_NO_LAZY_FETCH=1", "GIT_TERMINAL_PROMPT=0", "GIT_OPTIONAL_LOCKS=0"};
+    int count = sizeof(overrides) / sizeof(overrides[0]);
+    int i, j, e = 0;
+
+    for (j = 0; j < count; j++)
+        envp[e++] = overrides[j];
+
+    for (i = 0; environ[i] != NULL; i++) {
+        for (j = 0; j < count; j++)
+            if (strncmp(environ[i], overrides[j], strchr(overrides[j], '=') - overrides[j] + 1) == 0)
+                break;
+
+        if (j < count)
+            continue;
+
+        /* without the overrides git is not started at all */
+        if (e == MAX_GIT_ENV - 1)
+            return NULL;
+
+        envp[e++] = environ[i];
+    }
+
+    envp[e] = NULL;
+
+    return envp;
+}
+
+/*
+ * posix_spawn does not copy the caller's page tables, which matters when the
+ * caller is a large process such as a Python interpreter. A detached git is
+ * forked twice instead and reparented to init at once, so a long lived caller
+ * is not left with a zombie when it stops reading before git is done. It
+ * cannot be waited for or killed, and the pid returned is no longer valid.
+ * With an out_fd, git writes its output there and its stderr to the pipe,
+ * whose end tells when git exits.
+ */
+static pid_t spawn_git(const char *dir, char **args, int *fd, int merge_stderr, int detach, int out_fd)
+{
+    posix_spawn_file_actions_t actions;
+    char *argv[MAX_GIT_ARGS];
+    char *envp[MAX_GIT_ENV];
+    char **env;
+    int pipefd[2];
+    int devnull;
+    int i, n = 0;
+    pid_t pid;
+
+    argv[n++] = "git";
+    if (dir != NULL) {
+        argv[n++] = "-C";
+        argv[n++] = (char *)dir;
+    }
+    for (i = 0; args[i] != NULL && n < MAX_GIT_ARGS - 1; i++)
+        argv[n++] = args[i];
+    argv[n] = NULL;
+
+    if ((env = git_environment(envp)) == NULL)
+        return -1;
+
+    /* keep concurrent spawns from leaking each other's pipe ends */
+    pthread_mutex_lock(&spawn_lock);
+
+    if (pipe(pipefd) < 0) {
+        pthread_mutex_unlock(&spawn_lock);
+        return -1;
+    }
+
+    fcntl(pipefd[0], F_SETFD, FD_CLOEXEC);
+    fcntl(pipefd[1], F_SETFD, FD_CLOEXEC);
+
+    if (!detach) {
+        posix_spawn_file_actions_init(&actions);
+        posix_spawn_file_actions_addopen(&actions, 0, "/dev/null", O_RDONLY, 0);
+        posix_spawn_file_actions_adddup2(&actions, out_fd >= 0 ? out_fd : pipefd[1], 1);
+        if (merge_stderr || out_fd >= 0)
+            posix_spawn_file_actions_adddup2(&actions, pipefd[1], 2);
+        else
+            posix_spawn_file_actions_addopen(&actions, 2, "/dev/null", O_WRONLY, 0);
+        if (posix_spawnp(&pid, argv[0], &actions, NULL, argv, env) != 0)
+            pid = -1;
+        posix_spawn_file_actions_destroy(&actions);
+    } else if ((pid = fork()) == 0) {
+        if (fork() != 0)
+            _exit(EXIT_SUCCESS);
+        if ((devnull = open("/dev/null", O_RDWR)) >= 0)
+            dup2(devnull, 0);
+        dup2(out_fd >= 0 ? out_fd : pipefd[1], 1);
+        if (merge_stderr || out_fd >= 0)
+            dup2(pipefd[1], 2);
+        else if (devnull >= 0)
+            dup2(devnull, 2);
+        environ = env;
+        execvp(argv[0], argv);
+        _exit(127);
+    }
+
+    pthread_mutex_unlock(&spawn_lock);
+
+    close(pipefd[1]);
+
+    if (pid < 0) {
+        close(pipefd[0]);
+        return -1;
+    }
+
+    if (detach)
+        waitpid(pid, NULL, 0);
+
+    *fd = pipefd[0];
+
+    return pid;
+}
+
+static struct submodule *list_submodules(struct gs_arena *arena, const char *top)
+{
+    struct submodule *list = NULL, *sm;
+    char *line, *path, *p, *end, *buf;
+    struct reader r;
+    int fd;
+
+    if ((path = gs_alloc(arena, MAX_PATH_LENGTH)) == NULL || (buf = gs_alloc(arena, LINE_BUFFER)) == NULL)
+        return NULL;
+
+    snprintf(path, MAX_PATH_LENGTH, "%s/.gitmodules", top);
+
+    if ((fd = open(path, O_RDONLY | O_CLOEXEC)) < 0)
+        return NULL;
+
+    reader_init(&r, fd, buf, LINE_BUFFER, 0);
+
+    while (read_line(&r, &line) >= 0) {
+        for (p = line; *p == ' ' || *p == '\t'; p++)
+            ;
+        if (strncmp(p, "path", 4) != 0)
+            continue;
+        for (p += 4; *p == ' ' || *p == '\t'; p++)
+            ;
+        if (*p++ != '=')
+            continue;
+        for (; *p == ' ' || *p == '\t'; p++)
+            ;
+        for (end = p + strlen(p); end > p && isspace((unsigned char)end[-1]); end--)
+            ;
+        *end = '\0';
+
+        snprintf(path, MAX_PATH_LENGTH, "%s/%s/.git", top, p);
+
+        /* an uninitialized submodule has nothing to report */
+        if (!is_file(path) && !is_directory(path))
+            continue;
+
+        path[strlen(path) - 5] = '\0';
+
+        if ((sm = gs_alloc(arena, sizeof(*sm))) == NULL || (sm->path = arena_strndup(arena, path, strlen(path))) == NULL)
+            break;
+
+        memset(&sm->counts, 0, sizeof(sm->counts));
+        sm->next = list;
+        list = sm;
+    }
+
+    close(fd);
+
+    return list;
+}
+
+static void evaluate_submodule(struct submodule *sm, int mode, int timeout, char *buf)
+{
+    char *args[] = {"status", "--porcelain", NULL};
+    struct gs_submodules *counts = &sm->counts;
+    struct reader r;
+    char *line;
+    int fd;
+    pid_t pid;
+
+    if ((pid = spawn_git(sm->path, args, &fd, 0, 0, -1)) < 0)
+        return;
+
+    reader_init(&r, fd, buf, LINE_BUFFER, timeout > 0 ? now_ms() + timeout : 0);
+
+    while (read_line(&r, &line) >= 0) {
+        counts->dirty = 1;
+        if (mode == GS_SUBMODULES_DIRTY)
+            break;
+        count_stat_line(line, &counts->staged, &counts->conflicts, &counts->changed, &counts->untracked);
+    }
+
+    counts->timeout = r.timeout;
+
+    close(fd);
+    /* not SIGKILL, git removes its lock files on SIGTERM */
+    if (!r.eof)
+        kill(pid, SIGTERM);
+    waitpid(pid, NULL, 0);
+}
+
+static void *submodule_worker(void *arg)
+{
+    struct submodule_worker *worker = arg;
+    struct submodule_pool *pool = worker->pool;
+    struct submodule *sm;
+
+    for (;;) {
+        pthread_mutex_lock(&pool->lock);
+        if ((sm = pool->next) != NULL)
+            pool->next = sm->next;
+        pthread_mutex_unlock(&pool->lock);
+
+        if (sm == NULL)
+            break;
+
+        evaluate_submodule(sm, pool->mode, pool->timeout, worker->buf);
+    }
+
+    return NULL;
+}
+
+static void submodule_status(struct gs_arena *arena, const char *top, const struct gs_options *opts,
+                             struct gs_submodules *total)
+{
+    struct submodule_worker *workers;
+    struct submodule_pool pool;
+    struct submodule *list, *sm;
+    int i, count = 0, jobs;
+
+    memset(total, 0, sizeof(*total));
+
+    list = list_submodules(arena, top);
+    for (sm = list; sm != NULL; sm = sm->next)
+        count++;
+
+    if ((jobs = opts->jobs < count ? opts->jobs : count) == 0)
+        return;
+
+    pool.next = list;
+    pool.mode = opts->submodules;
+    pool.timeout = opts->submodule_timeout;
+    pthread_mutex_init(&pool.lock, NULL);
+
+    workers = gs_alloc(arena, jobs * sizeof(*workers));
+
+    for (i = 0; workers != NULL && i < jobs; i++) {
+        workers[i].pool = &pool;
+        if ((workers[i].buf = gs_alloc(arena, LINE_BUFFER)) == NULL)
+            break;
+        if (pthread_create(&workers[i].thread, NULL, submodule_worker, &workers[i]) != 0) {
+            /* if no thread could be started, evaluate serially */
+            if (i == 0)
+                submodule_worker(&workers[0]);
+            break;
+        }
+    }
+    jobs = i;
+
+    for (i = 0; i < jobs; i++)
+        pthread_join(workers[i].thread, NULL);
+
+    pthread_mutex_destroy(&pool.lock);
+
+    for (sm = list; sm != NULL; sm = sm->next) {
+        total->staged += sm->counts.staged;
+        total->conflicts += sm->counts.conflicts;
+        total->changed += sm->counts.changed;
+        total->untracked += sm->counts.untracked;
+        total->dirty += sm->counts.dirty;
+        total->timeout += sm->counts.timeout;
+    }
+}
+
+static int copy_oid(const char *line, char *oid)
+{
+    size_t n = strspn(line, "0123456789abcdef");
+
+    if (n != 40 && n != 64)
+        return 0;
+
+    memcpy(oid, line, n);
+    oid[n] = '\0';
+
+    return 1;
+}
+
+static int resolve_ref(struct gs_arena *arena, struct repo *repo, const char *ref, char *oid, int depth)
+{
+    size_t mark = arena->used;
+    struct reader r;
+    char *line, *name, *buf;
+    int found = 0;
+    int fd;
+
+    /* HEAD is per worktree, everything under refs/ is shared */
+    if (read_first_line(arena, strcmp(ref, "HEAD") ? repo->common_fd : repo->git_fd, ref, &line) >= 0) {
+        if (strncmp(line, "ref: refs/", 10) == 0)
+            found = depth < MAX_REF_DEPTH && resolve_ref(arena, repo, line + 5, oid, depth + 1);
+        else
+            found = copy_oid(line, oid);
+    }
+
+    arena->used = mark;
+
+    if (found)
+        return 1;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL || (fd = open_at(repo->common_fd, "packed-refs")) < 0) {
+        arena->used = mark;
+        return 0;
+    }
+
+    reader_init(&r, fd, buf, LINE_BUFFER, 0);
+
+    while (!found && read_line(&r, &line) >= 0) {
+        if ((name = strchr(line, ' ')) != NULL && strcmp(name + 1, ref) == 0)
+            found = copy_oid(line, oid);
+    }
+
+    close(fd);
+    arena->used = mark;
+
+    return found;
+}
+
+/* unique among the threads of a process, for temporary file names */
+static unsigned long next_tmp_id(void)
+{
+    static pthread_mutex_t lock = PTHREAD_MUTEX_INITIALIZER;
+    static unsigned long id;
+    unsigned long ret;
+
+    pthread_mutex_lock(&lock);
+    ret = ++id;
+    pthread_mutex_unlock(&lock);
+
+    return ret;
+}
+
+static int load_ab_cache(struct gs_arena *arena, int common_fd, struct ahead_behind *entries)
+{
+    size_t mark = arena->used;
+    struct reader r;
+    char *line, *buf;
+    int n = 0;
+    int fd;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL || (fd = open_at(common_fd, AB_CACHE_FILE)) < 0) {
+        arena->used = mark;
+        return 0;
+    }
+
+    reader_init(&r, fd, buf, LINE_BUFFER, 0);
+
+    while (n < AB_CACHE_SIZE && read_line(&r, &line) >= 0)
+        if (sscanf(line, "%71s %71s %d %d %255s", entries[n].local, entries[n].upstream, &entries[n].ahead,
+                   &entries[n].behind, entries[n].name) == 5)
+            n++;
+
+    close(fd);
+    arena->used = mark;
+
+    return n;
+}
+
+static void store_ab_cache(struct gs_arena *arena, int common_fd, struct ahead_behind *entry)
+{
+    size_t mark = arena->used;
+    size_t size = AB_CACHE_SIZE * (sizeof(struct ahead_behind) + 32);
+    struct ahead_behind *entries, *e;
+    char tmp_file[MAX_NAME_LENGTH];
+    char *buf;
+    size_t len;
+    int fd, i, n;
+
+    entries = gs_alloc(arena, AB_CACHE_SIZE * sizeof(*entries));
+    buf = gs_alloc(arena, size);
+
+    if (entries == NULL || buf == NULL) {
+        arena->used = mark;
+        return;
+    }
+
+    /* most recently used first, the last line falls off when full */
+    n = load_ab_cache(arena, common_fd, entries);
+
+    len = snprintf(buf, size, "%s %s %d %d %s\n", entry->local, entry->upstream, entry->ahead, entry->behind,
+                   entry->name);
+    for (i = 0; i < n && i < AB_CACHE_SIZE - 1; i++) {
+        e = &entries[i];
+        if (strcmp(e->local, entry->local) || strcmp(e->upstream, entry->upstream))
+            len += snprintf(buf + len, size - len, "%s %s %d %d %s\n", e->local, e->upstream, e->ahead, e->behind,
+                            e->name);
+    }
+
+    snprintf(tmp_file, sizeof(tmp_file), "%s.%ld.%lu", AB_CACHE_FILE, (long)getpid(), next_tmp_id());
+
+    if ((fd = openat(common_fd, tmp_file, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0644)) >= 0) {
+        if (write(fd, buf, len) != (ssize_t)len || close(fd) != 0 ||
+            renameat(common_fd, tmp_file, common_fd, AB_CACHE_FILE) != 0)
+            unlinkat(common_fd, tmp_file, 0);
+    }
+
+    arena->used = mark;
+}
+
+/* the counts a finished rev-list appended to the key in the lock file, moved to the cache */
+static int take_ab_count(struct gs_arena *arena, int common_fd, int lock_fd, struct ahead_behind *entry)
+{
+    size_t mark = arena->used;
+    char *buf;
+    ssize_t n;
+    int found = 0;
+
+    if ((buf = gs_alloc(arena, LINE_BUFFER)) == NULL)
+        return 0;
+
+    if ((n = pread(lock_fd, buf, LINE_BUFFER - 1, 0)) > 0) {
+        buf[n] = '\0';
+        if (sscanf(buf, "%71s %71s %255s %d %d", entry->local, entry->upstream, entry->name, &entry->ahead,
+                   &entry->behind) == 5) {
+            store_ab_cache(arena, common_fd, entry);
+            found = 1;
+        }
+    }
+
+    if (n != 0 && ftruncate(lock_fd, 0) != 0)
+        found = 0;
+
+    arena->used = mark;
+
+    return found;
+}
+
+static int ahead_behind_cached(struct gs_arena *arena, struct repo *repo, const struct gs_status *st, int timeout,
+                               int *ahead, int *behind)
+{
+    struct ahead_behind *entries, *entry, done;
+    char *args[] = {"rev-list", "--left-right", "--count", NULL, NULL};
+    char *ref, *range, *buf, *line;
+    struct reader r;
+    size_t len;
+    int i, n, fd, lock_fd, got;
+
+    entries = gs_alloc(arena, AB_CACHE_SIZE * sizeof(*entries));
+    entry = gs_alloc(arena, sizeof(*entry));
+    ref = gs_alloc(arena, MAX_PATH_LENGTH);
+    range = gs_alloc(arena, MAX_OID_LENGTH * 2 + 4);
+    buf = gs_alloc(arena, LINE_BUFFER);
+
+    if (entries == NULL || entry == NULL || ref == NULL || range == NULL || buf == NULL)
+        return GS_AB_NONE;
+
+    memset(entry, 0, sizeof(*entry));
+    snprintf(entry->name, sizeof(entry->name), "%.*s", (int)st->upstream_len, st->upstream);
+    snprintf(ref, MAX_PATH_LENGTH, "refs/remotes/%.*s", (int)st->upstream_len, st->upstream);
+
+    if (!resolve_ref(arena, repo, "HEAD", entry->local, 0))
+        return GS_AB_NONE;
+
+    if (!resolve_ref(arena, repo, ref, entry->upstream, 0)) {
+        snprintf(ref, MAX_PATH_LENGTH, "refs/heads/%.*s", (int)st->upstream_len, st->upstream);
+        if (!resolve_ref(arena, repo, ref, entry->upstream, 0))
+            return GS_AB_NONE;
+    }
+
+    n = load_ab_cache(arena, repo->common_fd, entries);
+
+    for (i = 0; i < n; i++) {
+        if (!strcmp(entries[i].local, entry->local) && !strcmp(entries[i].upstream, entry->upstream)) {
+            *ahead = entries[i].ahead;
+            *behind = entries[i].behind;
+            if (i > 0)
+                store_ab_cache(arena, repo->common_fd, &entries[i]);
+            return GS_AB_HIT;
+        }
+    }
+
+    /*
+     * A locked file means a count is already running in the background. git
+     * appends the counts to the key written in the file, and its stdout keeps
+     * the lock until it exits, so a count that outlives the prompt is picked up
+     * by the next one without anything but git running outside this process.
+     */
+    if ((lock_fd = openat(repo->common_fd, AB_LOCK_FILE, O_RDWR | O_CREAT | O_CLOEXEC, 0644)) >= 0 &&
+        flock(lock_fd, LOCK_EX | LOCK_NB) == 0) {
+        if (take_ab_count(arena, repo->common_fd, lock_fd, &done) && !strcmp(done.local, entry->local) &&
+            !strcmp(done.upstream, entry->upstream)) {
+            close(lock_fd);
+            *ahead = done.ahead;
+            *behind = done.behind;
+            return GS_AB_HIT;
+        }
+
+        snprintf(range, MAX_OID_LENGTH * 2 + 4, "%s...%s", entry->local, entry->upstream);
+        args[3] = range;
+        len = snprintf(buf, LINE_BUFFER, "%s %s %s ", entry->local, entry->upstream, entry->name);
+
+        if (write(lock_fd, buf, len) == (ssize_t)len && spawn_git(repo->top, args, &fd, 0, 1, lock_fd) > 0) {
+            reader_init(&r, fd, buf, LINE_BUFFER, timeout > 0 ? now_ms() + timeout : 0);
+
+            /* nothing but errors comes through the pipe, until git exits */
+            while (read_line(&r, &line) >= 0)
+                ;
+            close(fd);
+
+            if (!r.timeout) {
+                got = take_ab_count(arena, repo->common_fd, lock_fd, &done);
+                close(lock_fd);
+                if (!got)
+                    return GS_AB_NONE;
+                *ahead = done.ahead;
+                *behind = done.behind;
+                return GS_AB_MISS;
+            }
+        }
+    }
+
+    if (lock_fd >= 0)
+        close(lock_fd);
+
+    *ahead = 0;
+    *behind = 0;
+
+    for (i = 0; i < n; i++) {
+        if (!strcmp(entries[i].name, entry->name)) {
+            *ahead = entries[i].ahead;
+            *behind = entries[i].behind;
+            break;
+        }
+    }
+
+    return GS_AB_APPROX;
+}
+
+/* a lock on one of jobs slot files shared by every process of this user, -1 when all are taken */
+static int open_fetch_slot(struct gs_arena *arena, int jobs)
+{
+    const char *runtime = getenv("XDG_RUNTIME_DIR");
+    struct stat dir_stat;
+    size_t mark = arena->used;
+    char *path;
+    int i, n, fd = -1;
+
+    if ((path = gs_alloc(arena, MAX_PATH_LENGTH)) == NULL)
+        return -1;
+
+    if (runtime != NULL && runtime[0] == '/')
+        n = snprintf(path, MAX_PATH_LENGTH, "%s/gitstatus", runtime);
+    else
+        n = snprintf(path, MAX_PATH_LENGTH, "/tmp/gitstatus-%ld", (long)getuid());
+
+    /* the directory may be shared, use it only when it is ours */
+    if (n < MAX_PATH_LENGTH - 32 && (mkdir(path, 0700) == 0 || errno == EEXIST) && lstat(path, &dir_stat) == 0 &&
+        S_ISDIR(dir_stat.st_mode) && dir_stat.st_uid == getuid()) {
+        for (i = 0; i < jobs; i++) {
+            snprintf(path + n, MAX_PATH_LENGTH - n, "/fetch-slot-%d", i);
+            if ((fd = open(path, O_RDWR | O_CREAT | O_CLOEXEC, 0600)) < 0)
+                break;
+            if (flock(fd, LOCK_EX | LOCK_NB) == 0)
+                break;
+            close(fd);
+            fd = -1;
+        }
+    }
+
+    arena->used = mark;
+
+    return fd;
+}
+
+/*
+ * Start a detached git fetch when the repository is due one. Nothing here
+ * blocks: a repository already fetching, or no free slot, means no fetch this
+ * time and the next status tries again. The fetched refs show up in the
+ * ahead/behind counts of the following statuses.
+ */
+static void schedule_fetch(struct gs_arena *arena, struct repo *repo, const struct gs_options *opts)
+{
+    char *args[] = {"git", "-C", NULL, "fetch", "--quiet", NULL};
+    char *envp[MAX_GIT_ENV];
+    char **env;
+    char stamp[32], *line;
+    size_t mark = arena->used;
+    long now = (long)time(NULL), due = 0;
+    unsigned long jitter;
+    int lock_fd, slot_fd = -1, fd, len;
+    pid_t pid;
+
+    if (read_first_line(arena, repo->common_fd, FETCH_STAMP_FILE, &line) > 0)
+        due = strtol(line, NULL, 10);
+    arena->used = mark;
+
+    if (now < due)
+        return;
+
+    if ((lock_fd = openat(repo->common_fd, FETCH_LOCK_FILE, O_RDWR | O_CREAT | O_CLOEXEC, 0644)) < 0)
+        return;
+
+    if (flock(lock_fd, LOCK_EX | LOCK_NB) != 0 || (slot_fd = open_fetch_slot(arena, opts->fetch_jobs)) < 0)
+        goto done;
+
+    /* spread the next fetch over +-12.5% of the interval, so repos polled together drift apart */
+    jitter = ((unsigned long)now_ms() * 2654435761UL) ^ (unsigned long)getpid();
+    due = now + opts->fetch_interval - opts->fetch_interval / 8 + (long)(jitter % (opts->fetch_interval / 4 + 1));
+    len = snprintf(stamp, sizeof(stamp), "%ld\n", due);
+
+    if ((fd = openat(repo->common_fd, FETCH_STAMP_FILE, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0644)) < 0)
+        goto done;
+    if (write(fd, stamp, len) != len) {
+        close(fd);
+        goto done;
+    }
+    close(fd);
+
+    args[2] = repo->top;
+    if ((env = git_environment(envp)) == NULL)
+        goto done;
+
+    /* under the spawn lock, so no other thread's pipe is caught between pipe() and FD_CLOEXEC */
+    pthread_mutex_lock(&spawn_lock);
+
+    if ((pid = fork()) == 0) {
+        if (fork() != 0)
+            _exit(EXIT_SUCCESS);
+        setsid();
+        if ((fd = open("/dev/null", O_RDWR)) >= 0) {
+            dup2(fd, 0);
+            dup2(fd, 1);
+            dup2(fd, 2);
+        }
+        /* git holds both locks until it exits, or until the alarm kills it when it hangs */
+        fcntl(lock_fd, F_SETFD, 0);
+        fcntl(slot_fd, F_SETFD, 0);
+        alarm(FETCH_TIMEOUT);
+        environ = env;
+        execvp(args[0], args);
+        _exit(127);
+    }
+
+    pthread_mutex_unlock(&spawn_lock);
+
+    if (pid > 0)
+        waitpid(pid, NULL, 0);
+
+done:
+    if (slot_fd >= 0)
+        close(slot_fd);
+    close(lock_fd);
+}
+
+/* split the comma separated patterns, the ones past MAX_PRUNE_PATTERNS are dropped */
+static void parse_prune(struct gs_arena *arena, const char *spec, struct prune *prune)
+{
+    const char *p, *end;
+    size_t len;
+
+    prune->count = prune->found = prune->listed = 0;
+
+    for (p = spec; p != NULL && *p != '\0' && prune->count < MAX_PRUNE_PATTERNS; p = *end ? end + 1 : end) {
+        end = p + strcspn(p, ",");
+        len = end - p;
+        if (len == 0)
+            continue;
+
+        if ((prune->patterns[prune->count] = arena_strndup(arena, p, len)) == NULL)
+            break;
+        prune->count++;
+    }
+}
+
+/* directories matching a prune pattern down to depth levels below rel, without entering them */
+static void scan_pruned(struct gs_arena *arena, int dir_fd, const char *rel, int depth, struct prune *prune)
+{
+    struct dirent *entry;
+    struct stat entry_stat;
+    size_t mark;
+    char *path;
+    DIR *dir;
+    int i, fd, is_dir;
+
+    if ((dir = fdopendir(dir_fd)) == NULL) {
+        close(dir_fd);
+        return;
+    }
+
+    while ((entry = readdir(dir)) != NULL && prune->found < MAX_PRUNED_DIRS) {
+        if (strcmp(entry->d_name, ".") == 0 || strcmp(entry->d_name, "..") == 0 || strcmp(entry->d_name, ".git") == 0)
+            continue;
+
+        if (entry->d_type == DT_UNKNOWN)
+            is_dir = fstatat(dirfd(dir), entry->d_name, &entry_stat, AT_SYMLINK_NOFOLLOW) == 0 &&
+                     S_ISDIR(entry_stat.st_mode);
+        else
+            is_dir = entry->d_type == DT_DIR;
+
+        if (!is_dir)
+            continue;
+
+        mark = arena->used;
+        if ((path = gs_alloc(arena, strlen(rel) + strlen(entry->d_name) + 2)) == NULL)
+            break;
+        sprintf(path, "%s%s%s", rel, *rel ? "/" : "", entry->d_name);
+
+        for (i = 0; i < prune->count; i++)
+            if (fnmatch(prune->patterns[i], entry->d_name, 0) == 0)
+                break;
+
+        if (i < prune->count) {
+            prune->dirs[prune->found++] = path;
+            continue;
+        }
+
+        i = prune->found;
+        if (depth > 1 && (fd = openat(dirfd(dir), entry->d_name, O_RDONLY | O_DIRECTORY | O_NOFOLLOW | O_CLOEXEC)) >= 0)
+            scan_pruned(arena, fd, path, depth - 1, prune);
+
+        /* the paths of pruned directories found below are kept */
+        if (prune->found == i)
+            arena->used = mark;
+    }
+
+    closedir(dir);
+}
+
+/*
+ * The directories to prune, down to max_depth levels below the top. A single
+ * git ls-files of the tracked and untracked files in them tells which ones git
+ * lists as a whole, at their first untracked file, and which ones hold nothing
+ * to list, being empty or ignored. Both are kept. A directory with tracked
+ * files is left to git status, so their changes are still counted.
+ */
+static void find_pruned(struct gs_arena *arena, const char *top, const struct gs_options *opts, struct prune *prune)
+{
+    char *args[MAX_GIT_ARGS] = {"ls-files", "--cached", "--others", "--exclude-standard", "--directory",
+                                "--no-empty-directory", "--"};
+    size_t mark, len;
+    struct reader r;
+    char *buf, *line, *seen;
+    int i, n, nargs, fd, wstatus;
+    pid_t pid;
+
+    if ((fd = open(top, O_RDONLY | O_DIRECTORY | O_CLOEXEC)) < 0)
+        return;
+
+    scan_pruned(arena, fd, "", opts->untracked_max_depth, prune);
+
+    if (prune->found == 0)
+        return;
+
+    mark = arena->used;
+
+    for (nargs = 7, i = 0; i < prune->found; i++) {
+        if ((args[nargs] = gs_alloc(arena, strlen(prune->dirs[i]) + 11)) == NULL)
+            break;
+        sprintf(args[nargs++], ":(literal)%s", prune->dirs[i]);
+    }
+    args[nargs] = NULL;
+
+    n = 0;
+    if ((seen = gs_alloc(arena, prune->found)) != NULL && (buf = gs_alloc(arena, LINE_BUFFER)) != NULL &&
+        i == prune->found && (pid = spawn_git(top, args, &fd, 0, 0, -1)) >= 0) {
+        memset(seen, 0, prune->found);
+
+        /* 1 for the directory itself, 2 for anything below it */
+        reader_init(&r, fd, buf, LINE_BUFFER, 0);
+        while (read_line(&r, &line) >= 0) {
+            for (i = 0; i < prune->found; i++) {
+                len = strlen(prune->dirs[i]);
+                if (strncmp(line, prune->dirs[i], len) == 0 && line[len] == '/')
+                    seen[i] |= line[len + 1] == '\0' ? 1 : 2;
+            }
+        }
+
+        close(fd);
+
+        if (waitpid(pid, &wstatus, 0) == pid && WIFEXITED(wstatus) && WEXITSTATUS(wstatus) == 0) {
+            for (i = 0; i < prune->found; i++) {
+                if (seen[i] < 2) {
+                    prune->listed += seen[i];
+                    prune->dirs[n++] = prune->dirs[i];
+                }
+            }
+        }
+    }
+
+    prune->found = n;
+    arena->used = mark;
+}
+
+int gs_collect(const char *dir, int in_fd, const struct gs_options *opts, struct gs_arena *arena,
+               struct gs_status *st)
+{
+    char *args[MAX_GIT_ARGS];
+    struct prune prune;
+    struct reader in;
+    struct repo repo;
+    char *line, *buf;
+    long len;
+    int nargs = 0;
+    int i;
+    int different;
+    int wstatus, ok;
+    int prune_requested, untracked_all = 0;
+    int found;
+    int ret = GS_OK;
+    int fd = in_fd;
+    pid_t pid = -1;
+
+    gs_status_init(st);
+
+    repo.git_fd = repo.common_fd = -1;
+    prune.count = prune.found = prune.listed = 0;
+
+    prune_requested = in_fd < 0 && opts->untracked_prune != NULL && opts->untracked_max_depth > 0;
+
+    if ((found = find_git_root(arena, dir, &repo)) &&
+        (repo.git_fd = open(repo.git_root, O_RDONLY | O_DIRECTORY | O_CLOEXEC)) >= 0) {
+        find_common_dir(arena, &repo);
+        st->root = repo.top;
+        st->root_len = strlen(repo.top);
+        st->files = index_entries(repo.git_fd);
+        if ((repo.common_fd = open(repo.common, O_RDONLY | O_DIRECTORY | O_CLOEXEC)) >= 0)
+            st->mode = repo_mode(arena, &repo, prune_requested ? &untracked_all : NULL);
+    }
+
+    if (in_fd < 0) {
+        args[nargs++] = "status";
+        args[nargs++] = "--branch";
+        args[nargs++] = "--porcelain";
+        if (opts->submodules == GS_SUBMODULES_IGNORE)
+            args[nargs++] = "--ignore-submodules=all";
+        else if (opts->submodules != GS_SUBMODULES_DEFAULT)
+            args[nargs++] = "--ignore-submodules=dirty"; /* submodules are walked below */
+        if (st->mode & GS_REPO_PARTIAL)
+            args[nargs++] = "--no-renames"; /* rename detection reads blobs that may be missing */
+        if (opts->ab_cache)
+            args[nargs++] = "--no-ahead-behind"; /* counted below, through the cache */
+        /* in the default normal mode git stops at the first untracked file anyway */
+        if (found && prune_requested && untracked_all) {
+            parse_prune(arena, opts->untracked_prune, &prune);
+            if (prune.count > 0)
+                find_pruned(arena, repo.top, opts, &prune);
+        }
+        if (prune.found > 0) {
+            args[nargs++] = "--";
+            args[nargs++] = ":/";
+            for (i = 0; i < prune.found; i++) {
+                if ((args[nargs] = gs_alloc(arena, strlen(prune.dirs[i]) + 24)) == NULL) {
+                    ret = GS_ERROR;
+                    goto done;
+                }
+                sprintf(args[nargs++], ":(top,exclude,literal)%s", prune.dirs[i]);
+            }
+        }
+        args[nargs] = NULL;
+
+        if ((pid = spawn_git(dir, args, &fd, 0, 0, -1)) < 0) {
+            ret = GS_ERROR;
+            goto done;
+        }
+    }
+
+    if ((buf = gs_alloc(arena, STATUS_BUFFER)) == NULL) {
+        ret = GS_ERROR;
+        goto done;
+    }
+
+    reader_init(&in, fd, buf, STATUS_BUFFER, 0);
+
+    /* git prints nothing outside of a repository, its errors go to stderr */
+    if ((len = read_line(&in, &line)) < 0) {
+        ret = GS_NOT_A_REPO;
+        goto done;
+    }
+
+    /* anything else is not a status, such as a pipe fed with an error */
+    if (strncmp(line, "## ", 3) != 0) {
+        ret = GS_ERROR;
+        goto done;
+    }
+
+    if (!found || repo.git_fd < 0 || repo.common_fd < 0) {
+        ret = GS_NO_GIT_ROOT;
+        goto done;
+    }
+
+    if (gs_parse_branch(arena, line, len, repo.git_fd, st) < 0) {
+        ret = GS_ERROR;
+        goto done;
+    }
+
+    different = find(line, len, "[different]") != NULL;
+    st->stashes = stash_count(arena, repo.common_fd);
+    detect_operation(arena, repo.git_fd, st);
+
+    while ((len = read_line(&in, &line)) >= 0) {
+        gs_parse_stat_line(line, len, st);
+    }
+
+    if (pid > 0) {
+        close(fd);
+        ok = waitpid(pid, &wstatus, 0) == pid && WIFEXITED(wstatus) && WEXITSTATUS(wstatus) == 0;
+        pid = -1;
+        if (!ok) {
+            ret = GS_ERROR;
+            goto done;
+        }
+    }
+
+    /* each pruned directory git did not walk is one untracked entry */
+    st->untracked += prune.listed;
+
+    if (opts->fetch_interval > 0 && !st->local)
+        schedule_fetch(arena, &repo, opts);
+
+    if (opts->ab_cache && different)
+        st->ab_state = ahead_behind_cached(arena, &repo, st, opts->ab_timeout, &st->ahead, &st->behind);
+
+    if (opts->submodules == GS_SUBMODULES_DIRTY || opts->submodules == GS_SUBMODULES_FULL) {
+        st->submodules_mode = opts->submodules;
+        submodule_status(arena, repo.top, opts, &st->submodules);
+    }
+
+done:
+    if (pid > 0) {
+        close(fd);
+        waitpid(pid, NULL, 0);
+    }
+    if (repo.git_fd >= 0)
+        close(repo.git_fd);
+    if (repo.common_fd >= 0)
+        close(repo.common_fd);
+
+    return ret;
+}
+
+const char *gs_op_name(int op)
+{
+    return op > GS_OP_NONE && op <= GS_OP_BISECT ? operation_names[op] : NULL;
+}
+
+int gs_mode_name(int mode, char *out, size_t len)
+{
+    return snprintf(out, len, "%s%s%s", mode & GS_REPO_CONE ? "cone" : mode & GS_REPO_SPARSE ? "sparse" : "",
+                    mode & GS_REPO_SPARSE_INDEX ? "+sparse-index" : "",
+                    !(mode & GS_REPO_PARTIAL) ? "" : mode & GS_REPO_SPARSE ? "+partial" : "partial");
+}
+
+int gs_format(const struct gs_status *st, char *out, size_t len)
+{
+    char rebase[32] = "0";
+    char op[64] = "";
+    char mode[64] = "";
+    char mode_name[48];
+    char submodules[192] = "";
+    int n;
+
+    if (st->op == GS_OP_REBASE && st->op_step >= 0)
+        snprintf(rebase, sizeof(rebase), "%d/%d", st->op_step, st->op_total);
+
+    if (st->op != GS_OP_NONE && st->op_step >= 0)
+        snprintf(op, sizeof(op), " op=%s:%d/%d", gs_op_name(st->op), st->op_step, st->op_total);
+    else if (st->op != GS_OP_NONE)
+        snprintf(op, sizeof(op), " op=%s", gs_op_name(st->op));
+
+    if (st->mode != 0) {
+        gs_mode_name(st->mode, mode_name, sizeof(mode_name));
+        snprintf(mode, sizeof(mode), " mode=%s", mode_name);
+    }
+
+    if (st->submodules_mode == GS_SUBMODULES_FULL)
+        n = snprintf(submodules, sizeof(submodules),
+                     " sub_dirty=%d sub_staged=%d sub_conflicts=%d sub_changed=%d sub_untracked=%d",
+                     st->submodules.dirty, st->submodules.staged, st->submodules.conflicts,
+                     st->submodules.changed, st->submodules.untracked);
+    else if (st->submodules_mode == GS_SUBMODULES_DIRTY)
+        n = snprintf(submodules, sizeof(submodules), " sub_dirty=%d", st->submodules.dirty);
+    else
+        n = 0;
+
+    if (n >= (int)sizeof(submodules))
+        n = sizeof(submodules) - 1;
+
+    if (st->submodules.timeout > 0)
+        snprintf(submodules + n, sizeof(submodules) - n, " sub_timeout=%d", st->submodules.timeout);
+
+    return snprintf(out, len, "%.*s %d %d %d %d %d %d %d %d %.*s %d %s%s%s%s%s", (int)st->branch_len, st->branch,
+                    st->ahead, st->behind, st->staged, st->conflicts, st->changed, st->untracked, st->stashes,
+                    st->local, (int)st->upstream_len, st->upstream, st->merge, rebase, op, mode, submodules,
+                    st->ab_state == GS_AB_APPROX ? " ab_approx=1" : "");
+}
@@ -5,26 +5,76 @@ Fixtures used to to setup git repo scenarios on the fly.
 Tests are short and at the end of this file.
 """
 from __future__ import absolute_import, print_function
+import fcntl
 import os
 import re
 import shlex
 import shutil
 import subprocess as sub
 import tempfile
+import time
 
 import pytest
 
+try:
+    import _gitstatus
+except ImportError:
+    _gitstatus = None
+
 GIT_STATUS = os.path.join(os.path.dirname(__file__), 'gitstatus')
+ENGINE = {'name': 'binary'}
+
+
+def pytest_generate_tests(metafunc):
+    """
+    Run every test going through run_gitstatus against both the binary
+    and the Python binding.
+    """
+    if 'run_gitstatus' in metafunc.function.__code__.co_names:
+        metafunc.parametrize('gitstatus_engine', ['binary', 'binding'],
+                             indirect=True)
+
+
+@pytest.fixture(autouse=True)
+def gitstatus_engine(request):
+    """
+    Select what run_gitstatus drives, the binary unless parametrized.
+    """
+    engine = getattr(request, 'param', 'binary')
+    if engine == 'binding' and _gitstatus is None:
+        pytest.skip('the Python binding is not built, run make python')
+    ENGINE['name'] = engine
+    yield engine
+    ENGINE['name'] = 'binary'
+
+
+def binding_options(args):
+    """
+    Map gitstatus command line options to _gitstatus keyword arguments.
+    """
+    kwargs = {}
+    for arg in args:
+        name, _, value = arg.lstrip('-').partition('=')
+        kwargs[name.replace('-', '_')] = (int(value) if value.isdigit()
+                                          else value or True)
+    return kwargs
 
 
-def run_gitstatus():
+def run_gitstatus(*args):
     """
     Helper to simply run gitstatus in the current directory.
 
+    Args:
+        args: Extra command line options passed to gitstatus.
+
     Returns:
         The output of gitstatus.py in the CWD.
     """
-    return sub.check_output([GIT_STATUS]).decode('utf-8', errors='ignore')
+    if ENGINE['name'] == 'binding':
+        status = _gitstatus.status(**binding_options(args))
+        return '' if status is None else str(status)
+    cmd = [GIT_STATUS] + list(args)
+    return sub.check_output(cmd).decode('utf-8', errors='ignore')
 
 
 @pytest.yield_fixture(scope="function")
@@ -548,6 +598,69 @@ def git_repo_remote_behind():
         os.chdir(cwd)
 
 
+@pytest.yield_fixture(scope="function")
+def git_repo_remote_bare_moved():
+    """
+    Create a fake git repo with the following properties:
+        - upstream is a local bare repo, origin/master tracked
+        - another clone pushed 1 commit to it since the last fetch
+        - XDG_RUNTIME_DIR points to an empty folder for the fetch slots
+    """
+    cwd = os.getcwd()
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    folder = tempfile.mkdtemp()
+    folder_bare = folder + "_bare"
+    folder_other = folder + "_other"
+    folder_runtime = folder + "_runtime"
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "first:A single line",
+        "git add first",
+        "git commit -m 'first commit'",
+        "git clone --bare %s %s" % (folder, folder_bare),
+        "git remote add origin %s" % folder_bare,
+        "git fetch origin",
+        "git branch --set-upstream-to=origin/master",
+        "git clone %s %s" % (folder_bare, folder_other),
+        "%s/second:A single line" % folder_other,
+        "git -C %s add second" % folder_other,
+        "git -C %s -c user.email='you@example.com' -c user.name='Your Name' "
+        "commit -m 'second commit'" % folder_other,
+        "git -C %s push origin master" % folder_other,
+        "mkdir %s" % folder_runtime,
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    sub.check_call(shlex.split(cmd),
+                                   stdout=devnull, stderr=sub.STDOUT)
+
+        os.environ['XDG_RUNTIME_DIR'] = folder_runtime
+        yield
+
+    finally:
+        if runtime_dir is None:
+            os.environ.pop('XDG_RUNTIME_DIR', None)
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+        for path in (folder, folder_bare, folder_other, folder_runtime):
+            try:
+                shutil.rmtree(path)
+            except (OSError, IOError):
+                pass
+        os.chdir(cwd)
+
+
 @pytest.yield_fixture(scope="function")
 def git_repo_remote_diverged():
     """
@@ -778,6 +891,411 @@ def git_repo_upstream_gone():
             pass
         os.chdir(cwd)
 
+
+@pytest.yield_fixture(scope="function")
+def git_repo_with_submodules():
+    """
+    Create a fake git repo with the following properties:
+        - 2 commits, the second adds 2 submodules 'clean' and 'dirty'
+        - 'dirty' has 1 staged file, 1 changed file and 1 untracked file
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    folder_sub = folder + "_submodule"
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "first:A single line",
+        "git add first",
+        "git commit -m 'first commit'",
+        "cp -R %s %s" % (folder, folder_sub),
+        "git -c protocol.file.allow=always submodule add %s clean" % folder_sub,
+        "git -c protocol.file.allow=always submodule add %s dirty" % folder_sub,
+        "git commit -m 'add submodules'",
+        "dirty/second:A single line",
+        "git -C dirty add second",
+        "dirty/first:Changes but unstaged",
+        "dirty/untracked:A single line",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    sub.check_call(shlex.split(cmd),
+                                   stdout=devnull, stderr=sub.STDOUT)
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        try:
+            shutil.rmtree(folder_sub)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_untracked_dirs():
+    """
+    Create a fake git repo with the following properties:
+        - status.showUntrackedFiles is all
+        - 1 commit with first, sub/tracked and a .gitignore of .venv
+        - untracked node_modules/pkg with 2 files, sub/target with 1 file
+          and an untracked1 file
+        - an ignored .venv/lib with 1 file
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "git config status.showUntrackedFiles all",
+        "mkdir sub",
+        "first:A single line",
+        "sub/tracked:A single line",
+        ".gitignore:.venv",
+        "git add first sub .gitignore",
+        "git commit -m 'first commit'",
+        "mkdir -p node_modules/pkg sub/target .venv/lib",
+        "node_modules/pkg/a:A single line",
+        "node_modules/pkg/b:A single line",
+        "sub/target/x:A single line",
+        ".venv/lib/y:A single line",
+        "untracked1:A single line",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    sub.check_call(shlex.split(cmd),
+                                   stdout=devnull, stderr=sub.STDOUT)
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_sparse_checkout():
+    """
+    Create a fake git repo with the following properties:
+        - 1 commit with 2 folders, d_one and d_two
+        - cone mode sparse checkout of d_one with a sparse index
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "mkdir d_one d_two",
+        "d_one/first:A single line",
+        "d_two/second:A single line",
+        "git add d_one d_two",
+        "git commit -m 'first commit'",
+        "git sparse-checkout set --cone --sparse-index d_one",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    sub.check_call(shlex.split(cmd),
+                                   stdout=devnull, stderr=sub.STDOUT)
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_partial_clone():
+    """
+    Create a fake git repo with the following properties:
+        - blobless partial clone of a local upstream with 2 folders
+        - cone mode sparse checkout of d_one
+        - 1 changed file
+        - upstream deleted, so any lazy fetch would fail
+    """
+    cwd = os.getcwd()
+    folder_up = tempfile.mkdtemp()
+    folder = folder_up + "_clone"
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "git config uploadpack.allowFilter true",
+        "mkdir d_one d_two",
+        "d_one/first:A single line",
+        "d_two/second:A single line",
+        "git add d_one d_two",
+        "git commit -m 'first commit'",
+        "git clone --filter=blob:none --no-checkout file://%s %s" % (folder_up, folder),
+        "git -C %s sparse-checkout set --cone d_one" % folder,
+        "git -C %s checkout master" % folder,
+    ]
+    try:
+        os.chdir(folder_up)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder_up, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    sub.check_call(shlex.split(cmd),
+                                   stdout=devnull, stderr=sub.STDOUT)
+
+        os.chdir(folder)
+        shutil.rmtree(folder_up)
+        with open(os.path.join(folder, 'd_one', 'first'), 'a') as fout:
+            fout.write('Changes but unstaged\n')
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        try:
+            shutil.rmtree(folder_up)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_in_cherry_pick():
+    """
+    Create a fake git repo with the following properties:
+        - master branch with 2 commits
+        - dev branch with 2 commits, last one differs from master
+        - master is cherry picking the last dev commit, 1 conflict
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "first:A single line",
+        "git add first",
+        "git commit -m 'first commit'",
+        "git branch dev",
+        "first:the second master line here",
+        "git add first",
+        "git commit -m 'second master commit'",
+        "git checkout dev",
+        "first:Second line for dev",
+        "git add first",
+        "git commit -m 'second dev commit'",
+        "git checkout master",
+        "git cherry-pick dev",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    proc = sub.Popen(shlex.split(cmd),
+                                     stdout=devnull, stderr=sub.STDOUT)
+                    proc.wait()
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_in_revert():
+    """
+    Create a fake git repo with the following properties:
+        - master branch with 3 commits, the last two edit the same line
+        - reverting the second commit, 1 conflict
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "first:A single line",
+        "git add first",
+        "git commit -m 'first commit'",
+        "first:Second line",
+        "git add first",
+        "git commit -m 'second commit'",
+        "first:Third line",
+        "git add first",
+        "git commit -m 'third commit'",
+        "git revert --no-edit HEAD~1",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    proc = sub.Popen(shlex.split(cmd),
+                                     stdout=devnull, stderr=sub.STDOUT)
+                    proc.wait()
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+
+@pytest.yield_fixture(scope="function")
+def git_repo_in_bisect():
+    """
+    Create a fake git repo with the following properties:
+        - master branch with 2 commits
+        - bisecting with HEAD marked bad
+    """
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    cmds = [
+        "git init",
+        "git config user.email 'you@example.com'",
+        "git config user.name 'Your Name'",
+        "first:A single line",
+        "git add first",
+        "git commit -m 'first commit'",
+        "first:Second line",
+        "git add first",
+        "git commit -m 'second commit'",
+        "git bisect start",
+        "git bisect bad",
+    ]
+    try:
+        os.chdir(folder)
+
+        for cmd in cmds:
+            if re.match(r'\S+:', cmd):
+                assert len(cmd.split(":")) == 2
+                fname, text = cmd.split(":")
+                with open(os.path.join(folder, fname), 'a') as fout:
+                    fout.write(text + '\n')
+            else:
+                with open(os.devnull, 'w') as devnull:
+                    proc = sub.Popen(shlex.split(cmd),
+                                     stdout=devnull, stderr=sub.STDOUT)
+                    proc.wait()
+
+        yield
+
+    finally:
+        try:
+            shutil.rmtree(folder)
+        except (OSError, IOError):
+            pass
+        os.chdir(cwd)
+
+@pytest.yield_fixture(scope="session")
+def gitstatus_leak_checked():
+    """
+    A gitstatus command that fails on any leak or memory error: a build
+    with AddressSanitizer when the compiler supports it, else the plain
+    binary under valgrind. Skips when neither is available.
+    """
+    folder = tempfile.mkdtemp()
+    src = os.path.dirname(os.path.abspath(__file__))
+    binary = os.path.join(folder, 'gitstatus-asan')
+    cmd = ['cc', '-fsanitize=address', '-fno-omit-frame-pointer', '-g',
+           os.path.join(src, 'gitstatus.c'),
+           os.path.join(src, 'libgitstatus.c'), '-pthread', '-o', binary]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            if sub.call(cmd, stdout=devnull, stderr=sub.STDOUT) == 0:
+                yield [binary]
+            elif sub.call(['valgrind', '--version'], stdout=devnull,
+                          stderr=sub.STDOUT) == 0:
+                yield ['valgrind', '--leak-check=full', '--error-exitcode=23',
+                       '--errors-for-leak-kinds=definite,indirect',
+                       GIT_STATUS]
+            else:
+                pytest.skip('needs AddressSanitizer or valgrind')
+    except OSError:
+        pytest.skip('needs AddressSanitizer or valgrind')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def run_gitstatus_batch(cmd, lines, *args):
+    """
+    Feed lines to gitstatus --batch.
+
+    Returns:
+        The output lines and stderr.
+    """
+    env = dict(os.environ, ASAN_OPTIONS='detect_leaks=1:exitcode=23')
+    proc = sub.Popen(cmd + ['--batch'] + list(args), stdin=sub.PIPE,
+                     stdout=sub.PIPE, stderr=sub.PIPE, env=env)
+    out, err = proc.communicate(''.join(l + '\n' for l in lines).encode())
+    assert proc.returncode == 0, err
+    return (out.decode('utf-8', errors='ignore').splitlines(),
+            err.decode('utf-8', errors='ignore'))
+
+
 # ----------------
 # Functional Tests
 # ----------------
@@ -793,11 +1311,42 @@ def test_gitstatus_initial_commit(git_repo_initial_commit):
     assert run_gitstatus() == 'master 0 0 0 0 0 0 0 1 .. 0 0'
 
 
+def test_gitstatus_git_warnings(git_repo_branch_on_master):
+    """ A unit test for gitstatus. """
+    # git warns about grafts on stderr, which is not part of the status
+    head = sub.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    with open(os.path.join('.git', 'info', 'grafts'), 'w') as fout:
+        fout.write(head + '\n')
+    assert run_gitstatus() == 'master 0 0 0 0 0 0 0 1 .. 0 0'
+
+
 def test_gitstatus_local_branch(git_repo_branch_on_master):
     """ A unit test for gitstatus. """
     assert run_gitstatus() == 'master 0 0 0 0 0 0 0 1 .. 0 0'
 
 
+def test_gitstatus_large_environment(git_repo_branch_on_master):
+    """ A unit test for gitstatus. """
+    index = os.path.join('.git', 'index')
+    os.utime('first', (1, 1))
+    with open(index, 'rb') as fin:
+        before = fin.read()
+
+    # the overrides still reach git, GIT_OPTIONAL_LOCKS=0 keeps the index
+    env = dict(os.environ)
+    env.update(('GS_TEST_%d' % i, 'x') for i in range(1000))
+    out = sub.check_output([GIT_STATUS], env=env).decode('utf-8')
+    assert out == 'master 0 0 0 0 0 0 0 1 .. 0 0'
+    with open(index, 'rb') as fin:
+        assert fin.read() == before
+
+    # past what can be copied, git is not run without them
+    env.update(('GS_TEST_%d' % i, 'x') for i in range(3000))
+    proc = sub.Popen([GIT_STATUS], env=env, stdout=sub.PIPE, stderr=sub.PIPE)
+    out, err = proc.communicate()
+    assert (out, err) == (b'', b'Cannot run git\n')
+
+
 def test_gitstatus_on_hash(git_repo_branch_on_hash):
     """ A unit test for gitstatus. """
     actual_hash = sub.check_output(shlex.split('git rev-parse --short HEAD'))
@@ -812,7 +1361,7 @@ def test_gitstatus_parse_stats_no_conflicts(git_repo_parse_stats):
 
 def test_gitstatus_parse_stats_only_conflicts(git_repo_parse_stats_only_conflicts):
     """ A unit test for gitstatus. """
-    assert run_gitstatus() == 'master 1 1 0 1 0 0 0 0 up/master 1 0'
+    assert run_gitstatus() == 'master 1 1 0 1 0 0 0 0 up/master 1 0 op=merge'
 
 
 def test_gitstatus_remote_ahead(git_repo_remote_ahead):
@@ -830,6 +1379,80 @@ def test_gitstatus_remote_diverged(git_repo_remote_diverged):
     assert run_gitstatus() == 'master 1 2 0 0 0 0 0 0 up/master 0 0'
 
 
+def test_gitstatus_ahead_behind_cache(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    expected = 'master 1 2 0 0 0 0 0 0 up/master 0 0'
+    assert run_gitstatus('--ahead-behind-cache') == expected
+    assert os.path.isfile(os.path.join('.git', 'gitstatus-ahead-behind'))
+    assert run_gitstatus('--ahead-behind-cache') == expected
+
+
+def test_gitstatus_ahead_behind_background(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    args = ('--ahead-behind-cache', '--ahead-behind-timeout=1')
+    # a held lock means a count is already running in the background
+    with open(os.path.join('.git', 'gitstatus-ahead-behind.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        out = run_gitstatus(*args)
+    assert out == 'master 0 0 0 0 0 0 0 0 up/master 0 0 ab_approx=1'
+    for _ in range(50):
+        out = run_gitstatus(*args)
+        if 'ab_approx' not in out:
+            break
+        time.sleep(0.1)
+    assert out == 'master 1 2 0 0 0 0 0 0 up/master 0 0'
+
+
+def wait_gitstatus(expected, *args):
+    """
+    Run gitstatus until it prints expected, for at most 5 seconds.
+
+    Returns:
+        The last output of gitstatus.
+    """
+    for _ in range(50):
+        out = run_gitstatus(*args)
+        if out == expected:
+            break
+        time.sleep(0.1)
+    return out
+
+
+def test_gitstatus_background_fetch(git_repo_remote_bare_moved):
+    """ A unit test for gitstatus. """
+    stale = 'master 0 0 0 0 0 0 0 0 origin/master 0 0'
+    fresh = 'master 0 1 0 0 0 0 0 0 origin/master 0 0'
+    assert run_gitstatus() == stale
+    # the fetch runs after the status is read, this prompt is still stale
+    assert run_gitstatus('--fetch-interval=3600') == stale
+    assert wait_gitstatus(fresh) == fresh
+    assert os.path.isfile(os.path.join('.git', 'gitstatus-fetch'))
+
+    # not due again for an hour
+    sub.check_call(['git', 'update-ref', 'refs/remotes/origin/master',
+                    'HEAD'])
+    assert run_gitstatus('--fetch-interval=3600') == stale
+    time.sleep(0.5)
+    assert run_gitstatus() == stale
+
+
+def test_gitstatus_background_fetch_slots(git_repo_remote_bare_moved):
+    """ A unit test for gitstatus. """
+    stale = 'master 0 0 0 0 0 0 0 0 origin/master 0 0'
+    fresh = 'master 0 1 0 0 0 0 0 0 origin/master 0 0'
+    slots = os.path.join(os.environ['XDG_RUNTIME_DIR'], 'gitstatus')
+    os.mkdir(slots, 0o700)
+    # another shell holds the only slot
+    with open(os.path.join(slots, 'fetch-slot-0'), 'w') as slot:
+        fcntl.flock(slot, fcntl.LOCK_EX)
+        assert run_gitstatus('--fetch-interval=1', '--fetch-jobs=1') == stale
+        time.sleep(0.5)
+        assert run_gitstatus() == stale
+        assert not os.path.exists(os.path.join('.git', 'gitstatus-fetch'))
+    assert run_gitstatus('--fetch-interval=1', '--fetch-jobs=1') == stale
+    assert wait_gitstatus(fresh) == fresh
+
+
 def test_gitstatus_stdin(git_repo_parse_stats):
     """ A unit test for gitstatus. """
     std_input = sub.check_output(['git', 'status', '--branch', '--porcelain'])
@@ -840,18 +1463,404 @@ def test_gitstatus_stdin(git_repo_parse_stats):
     assert out == 'master 0 0 3 0 1 2 1 0 up/master 0 0'
 
 
+def test_gitstatus_stdin_not_a_status(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    with tempfile.TemporaryFile() as finput:
+        finput.write(b"fatal: cannot change to 'nope'\n")
+        finput.seek(0)
+        proc = sub.Popen([GIT_STATUS], stdin=finput, stdout=sub.PIPE,
+                         stderr=sub.PIPE)
+        out, err = proc.communicate()
+    assert (out, err) == (b'', b'Cannot run git\n')
+
+
 def test_gitstatus_merging(git_repo_in_merge):
     """ A unit test for gitstatus. """
-    assert run_gitstatus() == 'dev 0 0 0 1 0 0 0 1 .. 1 0'
+    assert run_gitstatus() == 'dev 0 0 0 1 0 0 0 1 .. 1 0 op=merge'
 
 
 def test_gitstatus_rebasing(git_repo_in_rebase):
     """ A unit test for gitstatus. """
     actual_hash = sub.check_output(shlex.split('git rev-parse --short HEAD'))
     actual_hash = actual_hash.decode('utf-8', errors='ignore').strip()
-    assert run_gitstatus() == ':{} 0 0 0 1 0 0 0 0 .. 0 1/2'.format(actual_hash)
+    expected = ':{} 0 0 0 1 0 0 0 0 .. 0 1/2 op=rebase:1/2'
+    assert run_gitstatus() == expected.format(actual_hash)
+
+
+def test_gitstatus_cherry_picking(git_repo_in_cherry_pick):
+    """ A unit test for gitstatus. """
+    assert run_gitstatus() == 'master 0 0 0 1 0 0 0 1 .. 0 0 op=cherry-pick'
+
+
+def test_gitstatus_reverting(git_repo_in_revert):
+    """ A unit test for gitstatus. """
+    assert run_gitstatus() == 'master 0 0 0 1 0 0 0 1 .. 0 0 op=revert'
+
+
+def test_gitstatus_bisecting(git_repo_in_bisect):
+    """ A unit test for gitstatus. """
+    assert run_gitstatus() == 'master 0 0 0 0 0 0 0 1 .. 0 0 op=bisect'
 
 
 def test_gitstatus_upstream_gone(git_repo_upstream_gone):
     """ A unit test for gitstatus. """
     assert run_gitstatus() == 'dev 0 0 0 0 0 0 0 0 up/dev 0 0'
+
+
+def test_gitstatus_submodules_default(git_repo_with_submodules):
+    """ A unit test for gitstatus. """
+    assert run_gitstatus() == 'master 0 0 0 0 1 0 0 1 .. 0 0'
+
+
+def test_gitstatus_submodules_ignore(git_repo_with_submodules):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus('--submodules=ignore')
+    assert out == 'master 0 0 0 0 0 0 0 1 .. 0 0'
+
+
+def test_gitstatus_submodules_dirty(git_repo_with_submodules):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus('--submodules=dirty')
+    assert out == 'master 0 0 0 0 0 0 0 1 .. 0 0 sub_dirty=1'
+
+
+@pytest.mark.parametrize('jobs', ['1', '8'])
+def test_gitstatus_submodules_full(git_repo_with_submodules, jobs):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus('--submodules=full', '--jobs=' + jobs)
+    assert out == ('master 0 0 0 0 0 0 0 1 .. 0 0 sub_dirty=1 sub_staged=1 '
+                   'sub_conflicts=0 sub_changed=1 sub_untracked=1')
+
+
+def test_gitstatus_submodules_no_locks(git_repo_with_submodules):
+    """ A unit test for gitstatus. """
+    index = os.path.join('.git', 'modules', 'clean', 'index')
+    # a stale stat in the index makes git status want to rewrite it
+    os.utime(os.path.join('clean', 'first'), (1, 1))
+    with open(index, 'rb') as fin:
+        before = fin.read()
+    run_gitstatus('--submodules=full')
+    with open(index, 'rb') as fin:
+        assert fin.read() == before
+
+    # statuses stopped at the time cap leave no lock behind either
+    for _ in range(10):
+        run_gitstatus('--submodules=full', '--submodule-timeout=1')
+    assert not os.path.exists(index + '.lock')
+
+
+def test_gitstatus_sparse_checkout(git_repo_sparse_checkout):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus()
+    assert out == 'master 0 0 0 0 0 0 0 1 .. 0 0 mode=cone+sparse-index'
+
+
+def test_gitstatus_partial_clone(git_repo_partial_clone):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus()
+    assert out == 'master 0 0 0 0 1 0 0 0 origin/master 0 0 mode=cone+partial'
+
+
+def test_gitstatus_untracked_prune(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    out = run_gitstatus()
+    assert out == 'master 0 0 0 0 0 4 0 1 .. 0 0'
+
+    out = run_gitstatus('--untracked-prune=node_modules,targ*,.venv')
+    assert out == 'master 0 0 0 0 0 3 0 1 .. 0 0'
+
+    os.chdir('sub')
+    out = run_gitstatus('--untracked-prune=node_modules,targ*,.venv')
+    assert out == 'master 0 0 0 0 0 3 0 1 .. 0 0'
+
+    # sub holds tracked files and is not pruned, sub/target/ is listed by git
+    out = run_gitstatus('--untracked-prune=node_modules,sub')
+    assert out == 'master 0 0 0 0 0 3 0 1 .. 0 0'
+
+
+def test_gitstatus_untracked_max_depth(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    # sub/target is out of reach and left to git, which lists it as one
+    out = run_gitstatus('--untracked-prune=node_modules,target',
+                        '--untracked-max-depth=1')
+    assert out == 'master 0 0 0 0 0 3 0 1 .. 0 0'
+
+    out = run_gitstatus('--untracked-prune=node_modules,target',
+                        '--untracked-max-depth=0')
+    assert out == 'master 0 0 0 0 0 4 0 1 .. 0 0'
+
+
+def test_gitstatus_untracked_prune_tracked(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    os.makedirs(os.path.join('src', 'build'))
+    with open(os.path.join('src', 'build', 'x.c'), 'w') as fout:
+        fout.write('first\n')
+    sub.check_call(['git', 'add', 'src'])
+    sub.check_call(['git', 'commit', '-q', '-m', 'build'])
+    with open(os.path.join('src', 'build', 'x.c'), 'a') as fout:
+        fout.write('staged\n')
+    sub.check_call(['git', 'add', 'src'])
+    with open(os.path.join('src', 'build', 'x.c'), 'a') as fout:
+        fout.write('changed\n')
+
+    # a directory with tracked files is not pruned, its changes count
+    expected = 'master 0 0 1 0 1 4 0 1 .. 0 0'
+    assert run_gitstatus() == expected
+    assert run_gitstatus('--untracked-prune=build') == expected
+
+
+def test_gitstatus_untracked_prune_nested(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    sub.check_call(['git', 'config', 'status.showUntrackedFiles', 'normal'])
+    os.makedirs(os.path.join('foo', 'node_modules'))
+    for fname in ('x', os.path.join('node_modules', 'y')):
+        with open(os.path.join('foo', fname), 'w') as fout:
+            fout.write('A single line\n')
+
+    # in normal mode git stops at the first untracked file, nothing is pruned
+    expected = 'master 0 0 0 0 0 4 0 1 .. 0 0'
+    assert run_gitstatus() == expected
+    assert run_gitstatus('--untracked-prune=node_modules') == expected
+
+    # with all, foo/x is listed on its own and foo/node_modules once
+    sub.check_call(['git', 'config', 'status.showUntrackedFiles', 'all'])
+    assert run_gitstatus() == 'master 0 0 0 0 0 6 0 1 .. 0 0'
+    out = run_gitstatus('--untracked-prune=node_modules')
+    assert out == 'master 0 0 0 0 0 5 0 1 .. 0 0'
+
+
+def test_gitstatus_untracked_prune_global(git_repo_untracked_dirs,
+                                          monkeypatch):
+    """ A unit test for gitstatus. """
+    sub.check_call(['git', 'config', '--unset', 'status.showUntrackedFiles'])
+    with tempfile.NamedTemporaryFile('w', suffix='.gitconfig') as fout:
+        fout.write('[status]\n\tshowUntrackedFiles = all\n')
+        fout.flush()
+        monkeypatch.setenv('GIT_CONFIG_GLOBAL', fout.name)
+        assert run_gitstatus() == 'master 0 0 0 0 0 4 0 1 .. 0 0'
+        out = run_gitstatus('--untracked-prune=node_modules,targ*')
+        assert out == 'master 0 0 0 0 0 3 0 1 .. 0 0'
+
+
+def test_gitstatus_untracked_prune_not_listed(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    os.makedirs('build')
+    os.makedirs(os.path.join('venv', 'lib'))
+    for fname, text in (('.gitignore', '*'), (os.path.join('lib', 'z'), 'z')):
+        with open(os.path.join('venv', fname), 'w') as fout:
+            fout.write(text + '\n')
+
+    # git lists neither an empty directory nor an ignored one
+    expected = 'master 0 0 0 0 0 4 0 1 .. 0 0'
+    assert run_gitstatus() == expected
+    assert run_gitstatus('--untracked-prune=build,venv') == expected
+
+
+def test_gitstatus_untracked_prune_hidden(git_repo_untracked_dirs):
+    """ A unit test for gitstatus. """
+    sub.check_call(['git', 'config', 'status.showUntrackedFiles', 'no'])
+    expected = 'master 0 0 0 0 0 0 0 1 .. 0 0'
+    assert run_gitstatus() == expected
+    assert run_gitstatus('--untracked-prune=node_modules,target') == expected
+
+
+def test_gitstatus_latency_log(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    folder = tempfile.mkdtemp()
+    log = os.path.join(folder, 'latency.csv')
+    try:
+        for _ in range(2):
+            sub.check_output([GIT_STATUS, '--ahead-behind-cache',
+                              '--log=' + log])
+        with open(log) as fin:
+            records = [line.rstrip('\n').split(',', 7) for line in fin]
+    finally:
+        shutil.rmtree(folder)
+    assert [r[2:] for r in records] == [
+        ['1', 'xs', 'miss', '-', 'default', os.getcwd()],
+        ['1', 'xs', 'hit', '-', 'default', os.getcwd()],
+    ]
+    assert all(int(r[0]) > 0 and int(r[1]) > 0 for r in records)
+
+
+def test_gitstatus_latency_log_rotation(git_repo_initial_commit):
+    """ A unit test for gitstatus. """
+    folder = tempfile.mkdtemp()
+    log = os.path.join(folder, 'latency.csv')
+    try:
+        for _ in range(30):
+            sub.check_output([GIT_STATUS, '--log=' + log, '--log-size=1'])
+        with open(log) as fin:
+            lines = len(fin.readlines())
+        with open(log + '.1') as fin:
+            rotated = len(fin.readlines())
+        assert os.path.getsize(log) < 1024 <= os.path.getsize(log + '.1')
+        assert lines + rotated == 30
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_gitstatus_report(empty_working_directory):
+    """ A unit test for gitstatus. """
+    log = os.path.join(os.getcwd(), 'latency.csv')
+    with open(log + '.1', 'w') as fout:
+        for _ in range(10):
+            fout.write('1,1500,10,xs,none,-,default,/fast\n')
+    with open(log, 'w') as fout:
+        for wall_ms in [50] * 8 + [300, 2500]:
+            fout.write('2,%d,200000,l,hit,cone,default,/slow, it is\n'
+                       % (wall_ms * 1000))
+        fout.write('not a record\n')
+
+    cmd = [GIT_STATUS, '--report', '--log=' + log]
+    proc = sub.Popen(cmd + ['--threshold=100'], stdout=sub.PIPE)
+    out = proc.communicate()[0].decode('utf-8')
+    assert proc.returncode == 1
+    assert out == """\
+2 repositories, 20 statuses, flagged when over 100 ms more than 10% of the time
+
+/slow, it is  SLOW
+  size l (200000 files), 10 statuses, mean 320.0 ms, max 2500.0 ms, 2 over 100 ms
+  ahead/behind cache: 10 hit, 0 miss, 0 approx
+    <  100 ms      8 ########################################
+    <  200 ms      0
+    <  500 ms      1 #####
+    < 1000 ms      0
+    < 2000 ms      0
+    < 5000 ms      1 #####
+
+/fast
+  size xs (10 files), 10 statuses, mean 1.5 ms, max 1.5 ms, 0 over 100 ms
+    <    2 ms     10 ########################################
+"""
+
+    out = sub.check_output(cmd + ['--threshold=500']).decode('utf-8')
+    assert 'SLOW' not in out
+
+
+def test_gitstatus_batch(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    expected = 'master 0 0 3 0 1 2 1 0 up/master 0 0'
+    folder = tempfile.mkdtemp()
+    try:
+        out, err = run_gitstatus_batch([GIT_STATUS],
+                                       [os.getcwd(), folder, '.'])
+    finally:
+        shutil.rmtree(folder)
+    assert out == [expected, '', expected]
+    assert err == 'Not a git repository\n'
+
+
+def test_gitstatus_batch_missing_path(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    expected = 'master 0 0 3 0 1 2 1 0 up/master 0 0'
+    out, err = run_gitstatus_batch([GIT_STATUS],
+                                   [os.path.join(os.getcwd(), 'nope'), '.'])
+    assert out == ['', expected]
+    assert err == 'Not a git repository\n'
+
+
+def test_gitstatus_batch_leaks_submodules(git_repo_with_submodules,
+                                          gitstatus_leak_checked):
+    """ A unit test for gitstatus. """
+    out, err = run_gitstatus_batch(gitstatus_leak_checked, ['.'] * 100,
+                                   '--submodules=full', '--jobs=4')
+    assert out == ['master 0 0 0 0 0 0 0 1 .. 0 0 sub_dirty=1 sub_staged=1 '
+                   'sub_conflicts=0 sub_changed=1 sub_untracked=1'] * 100
+    assert 'Sanitizer' not in err
+
+
+def test_gitstatus_batch_leaks_ahead_behind(git_repo_remote_diverged,
+                                            gitstatus_leak_checked):
+    """ A unit test for gitstatus. """
+    out, err = run_gitstatus_batch(gitstatus_leak_checked, ['.'] * 100,
+                                   '--ahead-behind-cache')
+    assert out == ['master 1 2 0 0 0 0 0 0 up/master 0 0'] * 100
+    assert 'Sanitizer' not in err
+
+
+def test_gitstatus_batch_ahead_behind_elsewhere(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    repo = os.getcwd()
+    os.chdir(tempfile.gettempdir())
+    out, _ = run_gitstatus_batch([GIT_STATUS], [repo] * 2,
+                                 '--ahead-behind-cache')
+    assert out == ['master 1 2 0 0 0 0 0 0 up/master 0 0'] * 2
+    assert os.path.isfile(os.path.join(repo, '.git', 'gitstatus-ahead-behind'))
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_fields(git_repo_parse_stats_only_conflicts):
+    """ A unit test for gitstatus. """
+    status = _gitstatus.status(os.getcwd())
+    assert (status.branch, status.upstream, status.local) == \
+        ('master', 'up/master', False)
+    assert (status.ahead, status.behind, status.staged, status.conflicts,
+            status.changed, status.untracked, status.stashes) == \
+        (1, 1, 0, 1, 0, 0, 0)
+    assert (status.op, status.op_progress, status.mode) == ('merge', None, None)
+    assert status.submodules is None and not status.ab_approx
+    with pytest.raises(AttributeError):
+        status.extra = 1
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_submodules(git_repo_with_submodules):
+    """ A unit test for gitstatus. """
+    status = _gitstatus.status(submodules='dirty')
+    assert status.submodules == {'dirty': 1, 'timeout': 0}
+    with pytest.raises(ValueError):
+        _gitstatus.status(submodules='sometimes')
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_ahead_behind_elsewhere(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    repo = os.getcwd()
+    os.chdir(tempfile.gettempdir())
+    status = _gitstatus.status(repo, ahead_behind_cache=True)
+    assert (status.ahead, status.behind) == (1, 2)
+    assert os.path.isfile(os.path.join(repo, '.git', 'gitstatus-ahead-behind'))
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_many_ahead_behind(git_repo_remote_diverged):
+    """ A unit test for gitstatus. """
+    statuses = _gitstatus.status_many([os.getcwd()] * 32, threads=8,
+                                      ahead_behind_cache=True)
+    # threads that find a count running show the approximate one
+    assert set((s.ahead, s.behind) for s in statuses
+               if not s.ab_approx) == set([(1, 2)])
+    status = _gitstatus.status(ahead_behind_cache=True)
+    assert (status.ahead, status.behind, status.ab_approx) == (1, 2, False)
+    assert [f for f in os.listdir('.git')
+            if f.startswith('gitstatus-ahead-behind.')] == \
+        ['gitstatus-ahead-behind.lock']
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_missing_path(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    assert _gitstatus.status(os.path.join(os.getcwd(), 'nope')) is None
+    assert _gitstatus.status_many(['nope', '.'])[0] is None
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_many_single_path(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    for paths in (os.getcwd(), os.getcwd().encode('utf-8')):
+        with pytest.raises(TypeError):
+            _gitstatus.status_many(paths)
+
+
+@pytest.mark.skipif(_gitstatus is None, reason='needs make python')
+def test_binding_status_many(git_repo_parse_stats):
+    """ A unit test for gitstatus. """
+    folder = tempfile.mkdtemp()
+    try:
+        statuses = _gitstatus.status_many([os.getcwd(), folder] * 20,
+                                          threads=4)
+    finally:
+        shutil.rmtree(folder)
+    assert [str(s) if s else s for s in statuses] == \
+        ['master 0 0 3 0 1 2 1 0 up/master 0 0', None] * 20
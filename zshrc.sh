@@ -8,9 +8,49 @@ chpwd_update_git_vars() {
 
 update_current_git_vars() {
     unset __CURRENT_GIT_STATUS
+    unset $__GIT_PROMPT_FIELDS
+    __GIT_PROMPT_FIELDS=()
 
     if [ "$__GIT_PROMPT_DISABLE" != "1" ]; then
-        local __GIT_CMD=$(git status --porcelain --branch &> /dev/null | $__GIT_PROMPT_DIR/gitstatus 2>/dev/null)
+        local -a __GIT_ARGS
+        local __GIT_FIELD __GIT_NAME
+
+        if [ -n "$ZSH_GIT_PROMPT_SUBMODULES" ]; then
+            __GIT_ARGS+=("--submodules=$ZSH_GIT_PROMPT_SUBMODULES")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_SUBMODULE_JOBS" ]; then
+            __GIT_ARGS+=("--jobs=$ZSH_GIT_PROMPT_SUBMODULE_JOBS")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_SUBMODULE_TIMEOUT" ]; then
+            __GIT_ARGS+=("--submodule-timeout=$ZSH_GIT_PROMPT_SUBMODULE_TIMEOUT")
+        fi
+        if [ "$ZSH_GIT_PROMPT_AHEAD_BEHIND_CACHE" = "1" ]; then
+            __GIT_ARGS+=("--ahead-behind-cache")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_AHEAD_BEHIND_TIMEOUT" ]; then
+            __GIT_ARGS+=("--ahead-behind-timeout=$ZSH_GIT_PROMPT_AHEAD_BEHIND_TIMEOUT")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_FETCH_INTERVAL" ]; then
+            __GIT_ARGS+=("--fetch-interval=$ZSH_GIT_PROMPT_FETCH_INTERVAL")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_FETCH_JOBS" ]; then
+            __GIT_ARGS+=("--fetch-jobs=$ZSH_GIT_PROMPT_FETCH_JOBS")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_UNTRACKED_PRUNE" ]; then
+            __GIT_ARGS+=("--untracked-prune=$ZSH_GIT_PROMPT_UNTRACKED_PRUNE")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_UNTRACKED_MAX_DEPTH" ]; then
+            __GIT_ARGS+=("--untracked-max-depth=$ZSH_GIT_PROMPT_UNTRACKED_MAX_DEPTH")
+        fi
+        if [ -n "$ZSH_GIT_PROMPT_LOG" ]; then
+            __GIT_ARGS+=("--log=${ZSH_GIT_PROMPT_LOG:A}")
+            if [ -n "$ZSH_GIT_PROMPT_LOG_SIZE" ]; then
+                __GIT_ARGS+=("--log-size=$ZSH_GIT_PROMPT_LOG_SIZE")
+            fi
+        fi
+
+        # gitstatus runs git itself when stdin is not a pipe or a file
+        local __GIT_CMD=$($__GIT_PROMPT_DIR/gitstatus "${__GIT_ARGS[@]}" </dev/null 2>/dev/null)
         __CURRENT_GIT_STATUS=("${(@s: :)__GIT_CMD}")
 
         GIT_BRANCH=$__CURRENT_GIT_STATUS[1]
@@ -25,9 +65,21 @@ update_current_git_vars() {
         GIT_UPSTREAM=$__CURRENT_GIT_STATUS[10]
         GIT_MERGING=$__CURRENT_GIT_STATUS[11]
         GIT_REBASE=$__CURRENT_GIT_STATUS[12]
+
+        # optional key=value fields, e.g. sub_dirty=2 becomes GIT_SUB_DIRTY=2
+        for __GIT_FIELD in $__CURRENT_GIT_STATUS[13,-1]; do
+            __GIT_NAME="GIT_${(U)__GIT_FIELD%%=*}"
+            typeset -g "$__GIT_NAME=${__GIT_FIELD#*=}"
+            __GIT_PROMPT_FIELDS+=("$__GIT_NAME")
+        done
     fi
 }
 
+# latency histograms of the prompts logged to ZSH_GIT_PROMPT_LOG, e.g. git_prompt_report --threshold=50
+git_prompt_report() {
+    $__GIT_PROMPT_DIR/gitstatus --report --log="${ZSH_GIT_PROMPT_LOG:A}" "$@"
+}
+
 gitoff() {
     __GIT_PROMPT_DISABLE=1
 }
@@ -47,6 +99,14 @@ git_super_status() {
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_REBASE$GIT_REBASE%{${reset_color}%}"
         elif [ "$GIT_MERGING" -ne "0" ]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_MERGING%{${reset_color}%}"
+        elif [ -n "$GIT_OP" ]; then
+            # GIT_OP is <operation>[:<step>/<total>], e.g. cherry-pick or am:1/3
+            local op_theme="ZSH_THEME_GIT_PROMPT_${(U)${GIT_OP%%:*}//-/_}"
+            STATUS="$STATUS${(P)op_theme}"
+            if [[ "$GIT_OP" == *:* ]]; then
+                STATUS="$STATUS${GIT_OP#*:}"
+            fi
+            STATUS="$STATUS%{${reset_color}%}"
         fi
 
         if [ "$GIT_LOCAL_ONLY" -ne "0" ]; then
@@ -62,6 +122,9 @@ git_super_status() {
         if [ "$GIT_BEHIND" -ne "0" ] || [ "$GIT_AHEAD" -ne "0" ]; then
             STATUS="$STATUS "
         fi
+        if [ "$GIT_AB_APPROX" = "1" ]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_APPROX%{${reset_color}%}"
+        fi
         if [ "$GIT_BEHIND" -ne "0" ]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_BEHIND$GIT_BEHIND%{${reset_color}%}"
         fi
@@ -87,6 +150,10 @@ git_super_status() {
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_UNTRACKED$GIT_UNTRACKED%{${reset_color}%}"
             clean=0
         fi
+        if [ -n "$GIT_SUB_DIRTY" ] && [ "$GIT_SUB_DIRTY" -ne "0" ]; then
+            STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_SUBMODULES$GIT_SUB_DIRTY%{${reset_color}%}"
+            clean=0
+        fi
         if [ "$GIT_STASHED" -ne "0" ]; then
             STATUS="$STATUS$ZSH_THEME_GIT_PROMPT_STASHED$GIT_STASHED%{${reset_color}%}"
             clean=0
@@ -118,6 +185,9 @@ colors
 # Allow for functions in the prompt
 setopt PROMPT_SUBST
 
+# Names of the optional GIT_* variables set by the last update
+typeset -ga __GIT_PROMPT_FIELDS
+
 # Hooks to make the prompt
 add-zsh-hook chpwd chpwd_update_git_vars
 add-zsh-hook precmd precmd_update_git_vars
@@ -134,8 +204,10 @@ ZSH_THEME_GIT_PROMPT_CONFLICTS="%{$fg[red]%}%{✖%G%}"
 ZSH_THEME_GIT_PROMPT_CHANGED="%{$fg[blue]%}%{✚%G%}"
 ZSH_THEME_GIT_PROMPT_BEHIND="%{↓·%2G%}"
 ZSH_THEME_GIT_PROMPT_AHEAD="%{↑·%2G%}"
+ZSH_THEME_GIT_PROMPT_APPROX="~"
 ZSH_THEME_GIT_PROMPT_STASHED="%{$fg_bold[blue]%}%{⚑%G%}"
 ZSH_THEME_GIT_PROMPT_UNTRACKED="%{$fg[cyan]%}%{…%G%}"
+ZSH_THEME_GIT_PROMPT_SUBMODULES="%{$fg[yellow]%}%{◆%G%}"
 ZSH_THEME_GIT_PROMPT_CLEAN="%{$fg_bold[green]%}%{✔%G%}"
 ZSH_THEME_GIT_PROMPT_LOCAL=" L"
 # The remote branch will be shown between these two
@@ -143,5 +215,9 @@ ZSH_THEME_GIT_PROMPT_UPSTREAM_FRONT=" {%{$fg[blue]%}"
 ZSH_THEME_GIT_PROMPT_UPSTREAM_END="%{${reset_color}%}}"
 ZSH_THEME_GIT_PROMPT_MERGING="%{$fg_bold[magenta]%}|MERGING%{${reset_color}%}"
 ZSH_THEME_GIT_PROMPT_REBASE="%{$fg_bold[magenta]%}|REBASE%{${reset_color}%} "
+ZSH_THEME_GIT_PROMPT_AM="%{$fg_bold[magenta]%}|AM%{${reset_color}%} "
+ZSH_THEME_GIT_PROMPT_CHERRY_PICK="%{$fg_bold[magenta]%}|CHERRY-PICKING%{${reset_color}%}"
+ZSH_THEME_GIT_PROMPT_REVERT="%{$fg_bold[magenta]%}|REVERTING%{${reset_color}%}"
+ZSH_THEME_GIT_PROMPT_BISECT="%{$fg_bold[magenta]%}|BISECTING%{${reset_color}%}"
 
 # vim: set filetype=zsh: